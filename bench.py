@@ -3,16 +3,18 @@ A much shorter version of train.py for benchmarking
 """
 import os
 from contextlib import nullcontext
-import numpy as np
 import time
 import torch
 from model import GPTConfig, GPT
+from dataloader import DataLoader, data_sources
 
 # -----------------------------------------------------------------------------
 batch_size = 12
 block_size = 1024
 bias = False
 real_data = True
+dataset = 'openwebtext'
+prefetch = 2 # batches prepared ahead on a background thread by the data loader, 0 = load in the loop
 seed = 1337
 device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
 dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32' or 'bfloat16' or 'float16'
@@ -31,16 +33,9 @@ ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=
 
 # data loading init
 if real_data:
-    dataset = 'openwebtext'
     data_dir = os.path.join('data', dataset)
-    train_data = np.memmap(os.path.join(data_dir, 'train.bin'), dtype=np.uint16, mode='r')
-    def get_batch(split):
-        data = train_data # note ignore split in benchmarking script
-        ix = torch.randint(len(data) - block_size, (batch_size,))
-        x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix])
-        y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix])
-        x, y = x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
-        return x, y
+    train_loader = DataLoader(data_sources(data_dir, 'train'), batch_size, block_size, device, prefetch=prefetch, seed=seed)
+    get_batch = lambda split: train_loader.next_batch()[:2] # note ignore split in benchmarking script
 else:
     # alternatively, if fixed data is desired to not care about data loading
     x = torch.randint(50304, (batch_size, block_size), device=device)
@@ -96,22 +91,27 @@ if profile:
 else:
 
     # simple benchmarking
-    torch.cuda.synchronize()
+    sync = torch.cuda.synchronize if device_type == 'cuda' else lambda: None
+    sync()
     for stage, num_steps in enumerate([10, 20]): # burnin, then benchmark
         t0 = time.time()
+        t_data = 0.0 # time the loop spends waiting for batches
         X, Y = get_batch('train')
         for k in range(num_steps):
             with ctx:
                 logits, loss = model(X, Y)
+            t = time.time()
             X, Y = get_batch('train')
+            t_data += time.time() - t
             optimizer.zero_grad(set_to_none=True)
             loss.backward()
             optimizer.step()
             lossf = loss.item()
             print(f"{k}/{num_steps} loss: {lossf:.4f}")
-        torch.cuda.synchronize()
+        sync()
         t1 = time.time()
         dt = t1-t0
         mfu = model.estimate_mfu(batch_size * 1 * num_steps, dt)
         if stage == 1:
             print(f"time per iteration: {dt/num_steps*1000:.4f}ms, MFU: {mfu*100:.2f}%")
+            print(f"waiting for data: {t_data/num_steps*1000:.4f}ms per iteration ({t_data/dt*100:.2f}% of the step)")
@@ -0,0 +1,67 @@
+"""
+Benchmark the sampling tail of generation (logits -> next token) in isolation, comparing
+the original temperature/top-k code path with the logits processor pipeline in model.py
+$ python bench_sampling.py --device=cpu --batch_size=1
+"""
+import time
+import torch
+from torch.nn import functional as F
+from model import Sampler
+
+# -----------------------------------------------------------------------------
+batch_size = 1
+vocab_size = 50304
+temperature = 0.8
+top_k = 200
+top_p = 0.95
+min_p = 0.05
+num_steps = 200
+seed = 1337
+device = 'cpu' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1' etc.
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+torch.manual_seed(seed)
+
+def baseline(logits, temperature, top_k):
+    # the sampling tail GPT.generate used to have
+    logits = logits / temperature
+    if top_k is not None:
+        v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
+        logits[logits < v[:, [-1]]] = -float('Inf')
+    probs = F.softmax(logits, dim=-1)
+    return torch.multinomial(probs, num_samples=1)
+
+def sync():
+    if 'cuda' in device:
+        torch.cuda.synchronize()
+
+def bench(name, fn):
+    # fresh logits every step, the pipeline works in place and would otherwise see -inf's
+    logits = [torch.randn(batch_size, vocab_size, device=device) * 4 for _ in range(8)]
+    for k in range(10): # burn in
+        fn(logits[k % len(logits)].clone())
+    sync()
+    dt_copy = time.time()
+    for k in range(num_steps):
+        logits[k % len(logits)].clone()
+    sync()
+    dt_copy = time.time() - dt_copy
+    t0 = time.time()
+    for k in range(num_steps):
+        fn(logits[k % len(logits)].clone())
+    sync()
+    dt = time.time() - t0 - dt_copy
+    print(f"{name:<40} {dt / num_steps * 1e6:10.1f}us/step")
+
+print(f"batch_size {batch_size}, vocab_size {vocab_size}, device {device}")
+bench(f"baseline temperature+top_k={top_k}", lambda l: baseline(l, temperature, top_k))
+bench(f"pipeline temperature+top_k={top_k}", Sampler(temperature, top_k))
+bench("baseline temperature (full vocab)", lambda l: baseline(l, temperature, None))
+bench("pipeline temperature (full vocab)", Sampler(temperature))
+bench(f"pipeline top_p={top_p}", Sampler(temperature, top_p=top_p))
+bench(f"pipeline min_p={min_p}", Sampler(temperature, min_p=min_p))
+history = torch.randint(vocab_size, (batch_size, 256), device=device)
+penalized = Sampler(temperature, top_k, repetition_penalty=1.2, frequency_penalty=0.2)
+bench(f"pipeline penalties+top_k={top_k}", lambda l: penalized(l, history))
+bench("pipeline greedy", Sampler(0))
@@ -0,0 +1,142 @@
+"""
+Checkpointing for train.py that does not stall training.
+Every save snapshots the tensors into (pinned) CPU buffers, which is the only part the training
+loop waits for, and a background thread writes them out. The optimizer state is sharded: with
+DDP every rank writes the state of every world_size'th parameter, so the writing is spread over
+all the processes. Files are written to a temporary name and renamed into place, and only the
+last keep_last checkpoints are kept. Layout of out_dir:
+    ckpt-000500.pt               model, model_args, iter_num, best_val_loss, config (rank 0)
+    optim-000500-0of2.pt         shard 0 of the optimizer state (rank 0)
+    optim-000500-1of2.pt         shard 1 of the optimizer state (rank 1)
+    ckpt.pt -> ckpt-000500.pt    the newest model, which is what sample.py and friends load
+"""
+import os
+import re
+import glob
+import threading
+import torch
+
+def ckpt_name(iter_num):
+    return f'ckpt-{iter_num:06d}.pt'
+
+def optim_name(iter_num, rank, world_size):
+    return f'optim-{iter_num:06d}-{rank}of{world_size}.pt'
+
+def by_iter(paths):
+    # ckpt-/optim- files oldest first, by the iteration number (past 999999 the names no longer sort)
+    return sorted(paths, key=lambda path: int(re.match(r'(?:ckpt|optim)-(\d+)', os.path.basename(path)).group(1)))
+
+def _atomic_save(obj, path):
+    torch.save(obj, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+class CheckpointWriter:
+
+    def __init__(self, out_dir, keep_last=3, rank=0, world_size=1, background=True):
+        self.out_dir = out_dir
+        self.keep_last = keep_last
+        self.rank = rank
+        self.world_size = world_size
+        self.background = background
+        self.buffers = {} # snapshot buffers, reused from one save to the next
+        self.thread = None
+        self.error = None
+
+    def _snapshot(self, obj, key='', seen=None):
+        # copy every tensor of a nested state dict into a cpu buffer of its own, tensors that are
+        # the same memory (the tied wte and lm_head weights) share one buffer and are written once
+        seen = {} if seen is None else seen
+        if isinstance(obj, torch.Tensor):
+            same = (obj.device, obj.data_ptr(), obj.shape, obj.stride(), obj.dtype)
+            if same in seen:
+                return seen[same]
+            buf = self.buffers.get(key)
+            if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+                buf = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=obj.is_cuda)
+                self.buffers[key] = buf
+            seen[same] = buf.copy_(obj.detach(), non_blocking=True)
+            return buf
+        if isinstance(obj, dict):
+            return {k: self._snapshot(v, f'{key}.{k}', seen) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, f'{key}.{i}', seen) for i, v in enumerate(obj))
+        return obj
+
+    def save(self, iter_num, checkpoint, optimizer):
+        """
+        checkpoint is the dict with the model and the run's metadata, only rank 0 writes it
+        (others may pass None); every rank passes its optimizer and writes its own shard of it.
+        """
+        self.wait() # the buffers are about to be overwritten
+        optim_state = optimizer.state_dict()
+        optim_state['state'] = {i: s for i, s in optim_state['state'].items() if i % self.world_size == self.rank}
+        snapshot = self._snapshot({'checkpoint': checkpoint, 'optimizer': optim_state})
+        if torch.cuda.is_available():
+            torch.cuda.synchronize() # the non_blocking copies must land before the writer reads the buffers
+        if self.background:
+            self.thread = threading.Thread(target=self._write, args=(iter_num, snapshot))
+            self.thread.start()
+        else:
+            self._write(iter_num, snapshot)
+            self.wait()
+
+    def _write(self, iter_num, snapshot):
+        try:
+            _atomic_save(snapshot['optimizer'], os.path.join(self.out_dir, optim_name(iter_num, self.rank, self.world_size)))
+            if snapshot['checkpoint'] is not None:
+                snapshot['checkpoint']['optimizer_shards'] = self.world_size
+                _atomic_save(snapshot['checkpoint'], os.path.join(self.out_dir, ckpt_name(iter_num)))
+                link = os.path.join(self.out_dir, 'ckpt.pt')
+                if os.path.lexists(link + '.tmp'):
+                    os.remove(link + '.tmp')
+                os.symlink(ckpt_name(iter_num), link + '.tmp')
+                os.replace(link + '.tmp', link)
+            self._cleanup()
+        except Exception as e:
+            self.error = e
+
+    def _cleanup(self):
+        # every rank removes its own old shards, rank 0 also the old models
+        if self.keep_last <= 0:
+            return
+        patterns = [f'optim-*-{self.rank}of*.pt'] + (['ckpt-*.pt'] if self.rank == 0 else [])
+        for pattern in patterns:
+            for path in by_iter(glob.glob(os.path.join(self.out_dir, pattern)))[:-self.keep_last]:
+                os.remove(path)
+
+    def wait(self):
+        # block until the checkpoint in flight is on disk
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+def latest_checkpoint(out_dir):
+    """ newest ckpt-<iter>.pt whose optimizer shards are all on disk, or ckpt.pt of older runs """
+    for path in reversed(by_iter(glob.glob(os.path.join(out_dir, 'ckpt-*.pt')))):
+        iter_num = int(re.search(r'ckpt-(\d+)\.pt$', path).group(1))
+        shards = glob.glob(os.path.join(out_dir, f'optim-{iter_num:06d}-*of*.pt'))
+        world_size = int(re.search(r'of(\d+)\.pt$', shards[0]).group(1)) if shards else 0
+        if shards and len(shards) == world_size:
+            return path
+    return os.path.join(out_dir, 'ckpt.pt')
+
+def load_optimizer_state(ckpt_path, checkpoint, map_location='cpu'):
+    # merge the shards of the optimizer state, which may have been written by any number of ranks
+    if 'optimizer' in checkpoint:
+        return checkpoint['optimizer'] # a checkpoint from before the sharded layout
+    out_dir = os.path.dirname(ckpt_path)
+    shards = glob.glob(os.path.join(out_dir, f"optim-{checkpoint['iter_num']:06d}-*of*.pt"))
+    if not shards:
+        return torch.load(os.path.join(out_dir, 'optim.pt'), map_location=map_location)
+    assert len(shards) == checkpoint['optimizer_shards'], f"missing optimizer shards for {ckpt_path}"
+    state = None
+    for path in shards:
+        shard = torch.load(path, map_location=map_location)
+        if state is None:
+            state = shard
+        else:
+            state['state'].update(shard['state'])
+    return state
@@ -2,6 +2,7 @@
 # https://github.com/HazyResearch/flash-attention/blob/main/training/src/datamodules/language_modeling_hf.py
 
 import os
+import json
 from tqdm import tqdm
 import numpy as np
 import tiktoken
@@ -9,7 +10,7 @@ from datasets import load_dataset # huggingface datasets
 
 # number of workers in .map() call
 # good number to use is ~order number of cpu cores // 2
-num_proc = 8
+num_proc = max(1, os.cpu_count() // 2)
 
 # number of workers in load_dataset() call
 # best number might be different from num_proc above as it also depends on NW speed.
@@ -59,7 +60,7 @@ if __name__ == '__main__':
     for split, dset in tokenized.items():
         arr_len = np.sum(dset['len'], dtype=np.uint64)
         filename = os.path.join(os.path.dirname(__file__), f'{split}.bin')
-        dtype = np.uint16 # (can do since enc.max_token_value == 50256 is < 2**16)
+        dtype = np.uint16 if enc.n_vocab <= 2**16 else np.uint32 # gpt2: enc.max_token_value == 50256 is < 2**16
         arr = np.memmap(filename, dtype=dtype, mode='w+', shape=(arr_len,))
         total_batches = 1024
 
@@ -72,10 +73,19 @@ if __name__ == '__main__':
             arr[idx : idx + len(arr_batch)] = arr_batch
             idx += len(arr_batch)
         arr.flush()
+        # the document index: start offset of every document in the .bin, plus the total length,
+        # used by the dataloader to pack whole documents into rows (train.py --packing=True)
+        offsets = np.concatenate([[0], np.cumsum(dset['len'], dtype=np.uint64)]).astype(np.uint64)
+        offsets.tofile(filename[:-len('.bin')] + '.idx')
+
+    # the dtype and vocabulary size of the tokens, for the loaders
+    with open(os.path.join(os.path.dirname(__file__), 'manifest.json'), 'w') as f:
+        json.dump({'encoding': enc.name, 'dtype': np.dtype(dtype).name, 'vocab_size': enc.n_vocab}, f, indent=2)
 
     # train.bin is ~17GB, val.bin ~8.5MB
     # train has ~9B tokens (9,035,582,198)
     # val has ~4M tokens (4,434,897)
 
     # to read the bin files later, e.g. with numpy:
-    # m = np.memmap('train.bin', dtype=np.uint16, mode='r')
+    # m = np.memmap('train.bin', dtype=json.load(open('manifest.json'))['dtype'], mode='r')
+    # and the document boundaries: np.fromfile('train.idx', dtype=np.uint64)
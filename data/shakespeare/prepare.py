@@ -1,4 +1,5 @@
 import os
+import json
 import requests
 import tiktoken
 import numpy as np
@@ -23,11 +24,14 @@ val_ids = enc.encode_ordinary(val_data)
 print(f"train has {len(train_ids):,} tokens")
 print(f"val has {len(val_ids):,} tokens")
 
-# export to bin files
-train_ids = np.array(train_ids, dtype=np.uint16)
-val_ids = np.array(val_ids, dtype=np.uint16)
+# export to bin files, uint16 unless the vocabulary does not fit
+dtype = np.uint16 if enc.n_vocab <= 2**16 else np.uint32
+train_ids = np.array(train_ids, dtype=dtype)
+val_ids = np.array(val_ids, dtype=dtype)
 train_ids.tofile(os.path.join(os.path.dirname(__file__), 'train.bin'))
 val_ids.tofile(os.path.join(os.path.dirname(__file__), 'val.bin'))
+with open(os.path.join(os.path.dirname(__file__), 'manifest.json'), 'w') as f:
+    json.dump({'encoding': enc.name, 'dtype': np.dtype(dtype).name, 'vocab_size': enc.n_vocab}, f, indent=2)
 
 # train.bin has 301,966 tokens
 # val.bin has 36,059 tokens
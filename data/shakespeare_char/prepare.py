@@ -1,10 +1,11 @@
 """
 Prepare the Shakespeare dataset for character-level language modeling.
 So instead of encoding with GPT-2 BPE tokens, we just map characters to ints.
-Will save train.bin, val.bin containing the ids, and meta.pkl containing the
-encoder and decoder and some other related info.
+Will save train.bin, val.bin containing the ids, manifest.json with their dtype,
+and meta.pkl containing the encoder and decoder and some other related info.
 """
 import os
+import json
 import pickle
 import requests
 import numpy as np
@@ -45,11 +46,14 @@ val_ids = encode(val_data)
 print(f"train has {len(train_ids):,} tokens")
 print(f"val has {len(val_ids):,} tokens")
 
-# export to bin files
-train_ids = np.array(train_ids, dtype=np.uint16)
-val_ids = np.array(val_ids, dtype=np.uint16)
+# export to bin files, uint16 unless the vocabulary does not fit
+dtype = np.uint16 if vocab_size <= 2**16 else np.uint32
+train_ids = np.array(train_ids, dtype=dtype)
+val_ids = np.array(val_ids, dtype=dtype)
 train_ids.tofile(os.path.join(os.path.dirname(__file__), 'train.bin'))
 val_ids.tofile(os.path.join(os.path.dirname(__file__), 'val.bin'))
+with open(os.path.join(os.path.dirname(__file__), 'manifest.json'), 'w') as f:
+    json.dump({'encoding': 'char', 'dtype': np.dtype(dtype).name, 'vocab_size': vocab_size}, f, indent=2)
 
 # save the meta information as well, to help us encode/decode later
 meta = {
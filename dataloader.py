@@ -0,0 +1,297 @@
+"""
+Batches of windows of a tokenized .bin file (as written by data/*/prepare.py), replacing the
+get_batch function train.py used to have. The file is mapped once, all the windows of a batch
+are gathered with a single fancy-indexing read of block_size+1 tokens each (x and y are two views
+of the same rows), converted to int64 once, and the next `prefetch` batches are prepared on a
+background thread, straight into pinned memory when training on a GPU.
+
+Windows are picked in one of two ways:
+- sampling='random': at random offsets, with replacement (what get_batch did)
+- sampling='epoch': every epoch is a seeded permutation of the non-overlapping block_size windows
+  of the file. With DDP each rank takes every world_size'th window of it, so no two ranks ever see
+  the same window, and state_dict()/load_state_dict() save and restore the position in the epoch.
+
+Instead of a single file the loader also reads a mixture of sources: any number of .bin files,
+each with a sampling weight and optionally restricted to a range of token offsets (a virtual
+subset, nothing is copied). A dataset directory with a mixture.json in it is such a mixture,
+see data_sources() below. Every row of a batch comes from one source, picked with probability
+proportional to the weights; with sampling='epoch' every source goes through seeded permutations
+of its own windows, and the sources are interleaved deterministically in proportion to their
+weights, so the position in the mixture is again just a few counters.
+
+With packing=True the rows are made of whole documents instead of arbitrary windows, using the
+document index (<split>.idx: uint64 start offsets of the documents, plus the total length) that
+the prepare.py scripts write next to the .bin. Documents are packed into rows of block_size+1
+tokens in (shuffled) order, next fit, the rest of a row being padding; documents longer than a
+row are cut into pieces of a row each. Batches then come with the document id of every position
+(-1 for padding) so the model can keep attention inside documents and restart the positions, and
+the targets that would cross from one document into the next (or into padding) are -1. The
+documents of all the sources are packed together, e.g. the shards of scripts/prepare-stream.py, so
+the sources are then weighted by their sizes (as data_sources() weights the files of a glob).
+"""
+import os
+import glob
+import json
+import mmap
+import queue
+import threading
+import numpy as np
+import torch
+
+def dataset_meta(data_dir):
+    """
+    dtype and vocab_size of the tokens of the dataset in data_dir, from the manifest.json that the
+    prepare scripts write next to the .bin files; datasets from before it existed are uint16
+    """
+    meta = {'dtype': 'uint16', 'vocab_size': None}
+    path = os.path.join(data_dir, 'manifest.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            manifest = json.load(f)
+        meta.update({k: manifest[k] for k in meta if k in manifest})
+    return meta
+
+def data_sources(data_dir, split):
+    """
+    The data of a split: data_dir/<split>.bin, or if data_dir has a mixture.json, the list of
+    sources given for the split there, e.g.
+    {
+      "train": [{"path": "../openwebtext/train.bin", "weight": 0.7},
+                {"path": "../tinystories/train.bin", "weight": 0.3, "end": 100000000}],
+      "val": [{"path": "../openwebtext/val.bin"}]
+    }
+    Paths are relative to data_dir and may be globs (e.g. a dataset written as shards), whose weight
+    is split over the matching files by size. "start"/"end" restrict a file to a range of tokens.
+    """
+    spec_path = os.path.join(data_dir, 'mixture.json')
+    if not os.path.exists(spec_path):
+        return os.path.join(data_dir, f'{split}.bin')
+    with open(spec_path) as f:
+        spec = json.load(f)
+    sources = []
+    for entry in spec[split]:
+        paths = sorted(glob.glob(os.path.join(data_dir, entry['path'])))
+        assert paths, f"no file matches {entry['path']} of {spec_path}"
+        assert len(paths) == 1 or ('start' not in entry and 'end' not in entry), "token ranges are for single files"
+        sizes = np.array([os.path.getsize(p) for p in paths], dtype=np.float64)
+        for path, size in zip(paths, sizes):
+            sources.append({**entry, 'path': path, 'weight': float(entry.get('weight', 1.0) * size / sizes.sum())})
+    return sources
+
+class DataLoader:
+
+    def __init__(self, path, batch_size, block_size, device='cpu', prefetch=2, seed=1337,
+                 sampling='random', rank=0, world_size=1, packing=False):
+        """ path: a .bin file, or a list of sources {'path', 'weight', 'start', 'end'} (see data_sources) """
+        assert sampling in ('random', 'epoch')
+        self.batch_size = batch_size
+        self.block_size = block_size
+        self.device = device
+        self.pin = 'cuda' in device
+        self.sampling = sampling
+        self.seed = seed # the permutations use it as is, all ranks must agree on them
+        self.rank = rank
+        self.world_size = world_size
+        self.packing = packing
+        self.rng = np.random.default_rng(seed + rank)
+        # map the files ourselves rather than with np.memmap, so that the pages we read can be handed
+        # back after every batch: touched pages of a long-lived mapping otherwise pile up in the RSS
+        sources = [{'path': path}] if isinstance(path, str) else path
+        self.mms, self.data = [], []
+        for source in sources:
+            with open(source['path'], 'rb') as f:
+                self.mms.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            dtype = dataset_meta(os.path.dirname(source['path']))['dtype'] # the sources of a mixture may differ
+            data = np.frombuffer(self.mms[-1], dtype=dtype)
+            self.data.append(data[source.get('start', 0):source.get('end', len(data))])
+            assert len(self.data[-1]) > block_size, f"{source['path']} is shorter than a block"
+        weights = np.array([source.get('weight', 1.0) for source in sources], dtype=np.float64)
+        self.p = weights / weights.sum()
+        self.window = np.arange(block_size + 1)
+        # with packing the documents of all sources are one pool, only a mixture of windows is interleaved
+        self.mixture = len(self.data) > 1 and not packing
+        if packing:
+            sizes = np.array([len(d) for d in self.data], dtype=np.float64)
+            assert np.allclose(self.p, sizes / sizes.sum(), rtol=1e-3), "packing weights the sources by their sizes"
+            doc_src, doc_starts, doc_lens = [], [], []
+            for s, source in enumerate(sources):
+                index_path = os.path.splitext(source['path'])[0] + '.idx'
+                assert os.path.exists(index_path), f"packing needs the document index {index_path}, see scripts/doc-index.py"
+                offsets = np.fromfile(index_path, dtype=np.uint64).astype(np.int64)
+                start, n = source.get('start', 0), len(self.data[s])
+                # cut at the ends of a token range, the documents there are cut short
+                offsets = np.unique(np.concatenate([[0], offsets[(offsets > start) & (offsets < start + n)] - start, [n]]))
+                doc_src.append(np.full(len(offsets) - 1, s))
+                doc_starts.append(offsets[:-1])
+                doc_lens.append(np.diff(offsets))
+            self.doc_src, self.doc_starts, self.doc_lens = map(np.concatenate, (doc_src, doc_starts, doc_lens))
+        # position in the epoch of the next batch to load, and of the last batch handed out; for a
+        # mixture, the number of windows taken so far from each source
+        self.epoch, self.position = 0, 0
+        self.taken = [0] * len(self.data)
+        self.perm = None
+        self.perms = {}
+        self.state = self._state()
+        if packing and sampling == 'random':
+            self.plan = self._pack(self.rng.permutation(len(self.doc_lens)))
+        elif sampling == 'epoch' and not self.mixture:
+            self._start_epoch(0)
+        # pinned buffers are reused round robin, each one waits for the copy out of it to finish first
+        self.slots = [None] * (prefetch + 2)
+        self.events = [None] * (prefetch + 2)
+        self.slot = 0
+        self.queue = queue.Queue(maxsize=prefetch) if prefetch > 0 else None
+        self.started = False
+
+    def _state(self):
+        if self.mixture:
+            return {'taken': list(self.taken)}
+        return {'epoch': self.epoch, 'position': self.position}
+
+    def state_dict(self):
+        # where the last batch handed out was taken from, resuming hands that batch out again
+        return dict(self.state)
+
+    def load_state_dict(self, state):
+        assert not self.started, "load the state before the first batch"
+        if self.mixture:
+            assert len(state['taken']) == len(self.data), "the state is of a different mixture"
+            self.taken = list(state['taken'])
+            return
+        self.epoch, self.position = state['epoch'], state['position']
+        if self.sampling == 'epoch':
+            self._start_epoch(self.epoch)
+
+    def _pack(self, order):
+        # pack the documents in this order into rows: returns the source, start and length of every
+        # piece of a document, and for every row the range of pieces in it
+        row = self.block_size + 1
+        src, starts, lens = self.doc_src[order], self.doc_starts[order], self.doc_lens[order]
+        n_pieces = -(-lens // row)
+        piece_doc = np.repeat(np.arange(len(order)), n_pieces)
+        piece_k = np.arange(len(piece_doc)) - np.repeat(np.cumsum(n_pieces) - n_pieces, n_pieces)
+        piece_starts = starts[piece_doc] + piece_k * row
+        piece_lens = np.minimum(lens[piece_doc] - piece_k * row, row)
+        row_ptr, fill = [0], 0
+        for i, n in enumerate(piece_lens.tolist()):
+            if fill + n > row:
+                row_ptr.append(i)
+                fill = 0
+            fill += n
+        row_ptr.append(len(piece_lens))
+        return src[piece_doc], piece_starts, piece_lens, np.array(row_ptr)
+
+    def _start_epoch(self, epoch):
+        # the order of the epoch: a permutation of the windows, or the rows of the shuffled documents
+        rng = np.random.default_rng([self.seed, epoch])
+        if self.packing:
+            self.plan = self._pack(rng.permutation(len(self.doc_lens)))
+            self.perm = np.arange(len(self.plan[3]) - 1)
+        else:
+            self.perm = rng.permutation((len(self.data[0]) - 1) // self.block_size)
+        assert len(self.perm) >= self.batch_size * self.world_size, "not enough data for a single batch"
+
+    def _mixture_items(self, step):
+        # the next step windows of the mixture, the same on every rank: every window goes to the source
+        # furthest behind its share, which takes the next window of its own stream of epochs
+        sources, ix = np.empty(step, dtype=np.int64), np.empty(step, dtype=np.int64)
+        for j in range(step):
+            s = int(np.argmax(self.p * (sum(self.taken) + 1) - self.taken))
+            n = (len(self.data[s]) - 1) // self.block_size
+            epoch, k = divmod(self.taken[s], n)
+            if (s, epoch) not in self.perms:
+                self.perms = {key: v for key, v in self.perms.items() if key[0] != s} # one epoch per source
+                self.perms[(s, epoch)] = np.random.default_rng([self.seed, s, epoch]).permutation(n)
+            sources[j], ix[j] = s, self.perms[(s, epoch)][k] * self.block_size
+            self.taken[s] += 1
+        return sources[self.rank::self.world_size], ix[self.rank::self.world_size]
+
+    def _items(self):
+        # the sources of the rows of the batch, and the windows (their starts) or packed rows (their numbers)
+        sources = np.zeros(self.batch_size, dtype=np.int64)
+        if self.sampling == 'random':
+            if self.packing:
+                return sources, self.rng.integers(0, len(self.plan[3]) - 1, self.batch_size)
+            if len(self.data) == 1:
+                return sources, self.rng.integers(0, len(self.data[0]) - self.block_size, self.batch_size)
+            sources = self.rng.choice(len(self.data), self.batch_size, p=self.p)
+            lens = np.array([len(d) for d in self.data])
+            return sources, self.rng.integers(0, lens[sources] - self.block_size)
+        step = self.batch_size * self.world_size # items consumed by all ranks together
+        if self.mixture:
+            return self._mixture_items(step)
+        if self.position + step > len(self.perm):
+            self.epoch, self.position = self.epoch + 1, 0 # drop the remainder, start the next epoch
+            self._start_epoch(self.epoch)
+        ix = self.perm[self.position + self.rank : self.position + step : self.world_size]
+        self.position += step
+        return sources, ix if self.packing else ix * self.block_size
+
+    def _rows(self, rows):
+        # assemble packed rows: (x, y, document ids) stacked into a single (3, B, T) array
+        piece_src, piece_starts, piece_lens, row_ptr = self.plan
+        tokens = np.zeros((len(rows), self.block_size + 1), dtype=np.int64)
+        docs = np.full((len(rows), self.block_size + 1), -1, dtype=np.int64)
+        for r, row in enumerate(rows):
+            fill = 0
+            for j in range(row_ptr[row], row_ptr[row + 1]):
+                s, n = piece_starts[j], piece_lens[j]
+                tokens[r, fill:fill+n] = self.data[piece_src[j]][s:s+n]
+                docs[r, fill:fill+n] = j - row_ptr[row]
+                fill += n
+        same = (docs[:, 1:] == docs[:, :-1]) & (docs[:, 1:] >= 0)
+        return np.stack((tokens[:, :-1], np.where(same, tokens[:, 1:], -1), docs[:, :-1]))
+
+    def _windows(self, sources, ix):
+        # one read per source for all the rows that come from it
+        if len(self.data) == 1:
+            return self.data[0][ix[:, None] + self.window]
+        batch = np.empty((len(ix), self.block_size + 1), dtype=np.int64)
+        for s in np.unique(sources):
+            rows = sources == s
+            batch[rows] = self.data[s][ix[rows, None] + self.window]
+        return batch
+
+    def _load(self):
+        # gather all the windows in one read and convert them to int64 once, into pinned memory on cuda
+        taken = list(self.taken)
+        sources, items = self._items()
+        batch = self._rows(items) if self.packing else self._windows(sources, items)
+        # where this batch was taken from, after the switch to the next epoch if there was one
+        step = self.batch_size * self.world_size if self.sampling == 'epoch' else 0
+        state = {'taken': taken} if self.mixture else {'epoch': self.epoch, 'position': self.position - step}
+        if hasattr(mmap, 'MADV_DONTNEED'):
+            for s in (range(len(self.mms)) if self.packing else np.unique(sources)):
+                self.mms[s].madvise(mmap.MADV_DONTNEED)
+        if not self.pin:
+            return state, batch.astype(np.int64, copy=False)
+        i = self.slot
+        self.slot = (self.slot + 1) % len(self.slots)
+        if self.slots[i] is None:
+            self.slots[i] = torch.empty(batch.shape, dtype=torch.int64, pin_memory=True)
+        if self.events[i] is not None:
+            self.events[i].synchronize()
+        self.slots[i].numpy()[...] = batch
+        return state, (i, self.slots[i])
+
+    def _worker(self):
+        while True:
+            self.queue.put(self._load())
+
+    def next_batch(self):
+        """ returns x, y and, with packing, the document ids of x (else None) """
+        if not self.started and self.queue is not None:
+            threading.Thread(target=self._worker, daemon=True).start()
+        self.started = True
+        self.state, batch = self.queue.get() if self.queue is not None else self._load()
+        if not self.pin:
+            batch = torch.from_numpy(batch).to(self.device)
+        else:
+            i, buf = batch
+            batch = buf.to(self.device, non_blocking=True)
+            self.events[i] = torch.cuda.Event()
+            self.events[i].record()
+        if self.packing:
+            return batch[0], batch[1], batch[2]
+        # x and y are the same rows shifted by one token, only split apart on the device
+        return batch[:, :-1].contiguous(), batch[:, 1:].contiguous(), None
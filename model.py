@@ -9,27 +9,85 @@ https://github.com/huggingface/transformers/blob/main/src/transformers/models/gp
 
 import math
 import inspect
-from dataclasses import dataclass
+from dataclasses import dataclass, asdict
 
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
 from functools import wraps # This convenience func preserves name and docstring
-import struct
+import os
+import json
 import base64
+import numpy as np
 
-def weights_to_base64(weights: list):
+def weights_to_base64(weights: list, max_bytes=100):
+    # encode straight from the tensor storage as native float32, and only copy out as many
+    # elements as fit in max_bytes (None = everything) instead of going through python floats
     weight_bytes = bytearray()
     for weight in weights:
-        if weight is not None:            
-            flatten = weight.reshape(-1).tolist()
-            flatten_packed = map(lambda i: struct.pack("@f", i), flatten)
-            for i in flatten_packed:
-                weight_bytes.extend(i)
-    weight_bytes = weight_bytes[:100]
+        if weight is None:
+            continue
+        if max_bytes is not None and len(weight_bytes) >= max_bytes:
+            break
+        flatten = weight.detach().reshape(-1)
+        if max_bytes is not None:
+            flatten = flatten[:(max_bytes - len(weight_bytes) + 3) // 4]
+        weight_bytes += flatten.to('cpu', torch.float32).numpy().tobytes()
+    weight_bytes = weight_bytes[:max_bytes]
     weight_base64 = base64.b64encode(weight_bytes).decode()
     return weight_base64
 
+class WeightFile:
+    """
+    Weight blob of a full-weight export: get_config(weight_file=...) appends the weights here and
+    refers to them by shape, dtype and byte offset instead of inlining them as base64. Tensors are
+    stored as little-endian float32, each starting at a multiple of `alignment` bytes, so the blob
+    can be memory-mapped and used in place. A parameter shared by two layers (the tied wte/lm_head)
+    is written once and both layers point at it.
+    """
+
+    def __init__(self, path, alignment=64, relative_to=None):
+        self.path = path
+        # the path recorded in the configs, relative to the manifest that will refer to it
+        self.name = os.path.relpath(path, relative_to) if relative_to is not None else os.path.basename(path)
+        self.alignment = alignment
+        self.f = open(path, 'wb')
+        self.offset = 0
+        self.written = {} # id of a parameter -> (parameter, its tensor entry)
+
+    def write_tensor(self, weight):
+        if isinstance(weight, nn.Parameter) and id(weight) in self.written:
+            return self.written[id(weight)][1]
+        buf = weight.detach().to('cpu', torch.float32).contiguous().numpy().astype('<f4', copy=False)
+        pad = -self.offset % self.alignment
+        self.f.write(bytes(pad))
+        self.offset += pad
+        entry = {"shape": list(buf.shape), "dtype": "float32", "offset": self.offset, "nbytes": buf.nbytes}
+        self.f.write(memoryview(buf).cast('B')) # no copy for float32 cpu tensors
+        self.offset += buf.nbytes
+        if isinstance(weight, nn.Parameter):
+            self.written[id(weight)] = (weight, entry)
+        return entry
+
+    def write(self, weights: dict):
+        tensors = {name: self.write_tensor(w) for name, w in weights.items() if w is not None}
+        return {"type": "file", "path": self.name, "byteorder": "little", "tensors": tensors}
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def export_weights(weights: dict, weight_file=None):
+    # the "weight" entry of a layer config: a truncated base64 preview, or the tensors' place in the weight file
+    if weight_file is not None:
+        return weight_file.write(weights)
+    return {"type": "base64", "data": weights_to_base64(list(weights.values()))}
+
 def add_method(cls):
     def decorator(func):
         @wraps(func) 
@@ -41,8 +99,8 @@ def add_method(cls):
     return decorator
 
 @add_method(nn.Linear)
-def get_config(self):
-    weights = [self.weight, self.bias]
+def get_config(self, weight_file=None):
+    weights = {"weight": self.weight, "bias": self.bias}
     return {
         "class_name": "Dense",
         "config": {
@@ -51,25 +109,19 @@ def get_config(self):
             "bias": self.bias is not None,
             "activation": "linear", # Pytorch dense layer do not have activation at the end
         },
-        "weight": {
-            "type": "base64",
-            "data": weights_to_base64(weights),
-        }
+        "weight": export_weights(weights, weight_file),
     }
 
 @add_method(nn.Embedding)
-def get_config(self):
-    weights = [self.weight]
+def get_config(self, weight_file=None):
+    weights = {"weight": self.weight}
     return {
         "class_name": "Embedding",
         "config": {
             "input_dim": self.num_embeddings,
             "output_dim": self.embedding_dim,
         },
-        "weight": {
-            "type": "base64",
-            "data": weights_to_base64(weights),
-        }
+        "weight": export_weights(weights, weight_file),
     }
 
 @add_method(nn.GELU)
@@ -91,17 +143,124 @@ class LayerNorm(nn.Module):
     def forward(self, input):
         return F.layer_norm(input, self.weight.shape, self.weight, self.bias, 1e-5)
     
-    def get_config(self):
+    def get_config(self, weight_file=None):
+        weights = {"weight": self.weight, "bias": self.bias}
         return {
             "class_name": "LayerNorm",
             "config": {
                 "normalized_shape": self.ndim,
-                "bias": False
+                "bias": self.bias is not None,
+                "eps": 1e-5,
             },
-            "weight": {
-                "type": "base64",
-                "data": "rwwspS7SmUfvQ46wzyN/e..."
-            }
+            "weight": export_weights(weights, weight_file),
+        }
+
+class QuantizedLinear(nn.Module):
+    """
+    Weight-only quantized stand-in for nn.Linear, for inference. bits=8 stores int8 weights with
+    one scale per output channel; bits=4 packs two 4-bit weights per byte with a scale and offset
+    per group of group_size input features. Groups shrink to divide in_features, and a layer
+    whose groups end up other than 32, 64, 128 or 256 features falls back to int8. Activations
+    stay in floating point. On the CPU the matmul runs on PyTorch's int8/int4 weight-only kernels
+    (in bfloat16), elsewhere the weight is dequantized on the fly.
+    """
+
+    def __init__(self, in_features, out_features, bias=True, bits=8, group_size=64):
+        super().__init__()
+        assert bits in (4, 8), "only int8 and int4 weights are supported"
+        group_size = math.gcd(group_size, in_features) # shrink the groups of narrow layers to fit
+        if bits == 4 and group_size not in (32, 64, 128, 256):
+            bits = 8 # the int4 kernels only take these group sizes, this layer stays int8 (as it will when loaded)
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size
+        if bits == 8:
+            self.register_buffer('qweight', torch.zeros(out_features, in_features, dtype=torch.int8))
+            self.register_buffer('scales', torch.ones(out_features))
+            self.zeros = None
+        else:
+            self.register_buffer('qweight', torch.zeros(out_features, in_features // 2, dtype=torch.uint8))
+            self.register_buffer('scales', torch.ones(out_features, in_features // group_size))
+            self.register_buffer('zeros', torch.zeros(out_features, in_features // group_size))
+        self.register_buffer('bias', torch.zeros(out_features) if bias else None)
+        self._packed = None # kernel-specific weight layout, built on the first CPU forward
+
+    @classmethod
+    @torch.no_grad()
+    def from_linear(cls, linear, bits=8, group_size=64):
+        q = cls(linear.in_features, linear.out_features, linear.bias is not None, bits, group_size)
+        w = linear.weight.detach().float()
+        if q.bits == 8:
+            # symmetric, per output channel: w ~= qweight * scale, qweight in [-127, 127]
+            scales = (w.abs().amax(dim=1) / 127).clamp(min=1e-8)
+            q.qweight.copy_(torch.round(w / scales[:, None]).clamp(-127, 127))
+            q.scales.copy_(scales)
+        else:
+            # asymmetric, per group: w ~= (qweight - 8) * scale + zero, qweight in [0, 15]
+            wg = w.view(w.size(0), -1, q.group_size)
+            wmin, wmax = wg.amin(dim=2), wg.amax(dim=2)
+            scales = ((wmax - wmin) / 15).clamp(min=1e-8)
+            qw = torch.round((wg - wmin[..., None]) / scales[..., None]).clamp(0, 15).to(torch.uint8).view_as(w)
+            q.qweight.copy_(qw[:, 0::2] | (qw[:, 1::2] << 4))
+            q.scales.copy_(scales)
+            q.zeros.copy_(wmin + 8 * scales)
+        if linear.bias is not None:
+            q.bias.copy_(linear.bias.detach())
+        return q.to(linear.weight.device)
+
+    def _unpack(self):
+        # int4 weights as (out_features, in_features) integers in [0, 15]
+        return torch.stack((self.qweight & 0xF, self.qweight >> 4), dim=-1).view(self.out_features, self.in_features)
+
+    def dequantize(self):
+        if self.bits == 8:
+            return self.qweight.float() * self.scales[:, None]
+        w = self._unpack().float().view(self.out_features, -1, self.group_size) - 8
+        return (w * self.scales[..., None] + self.zeros[..., None]).view(self.out_features, self.in_features)
+
+    def _cpu_kernel(self):
+        # the fused kernels want bfloat16 activations, int8 needs in_features % 16 == 0 (it returns
+        # garbage or crashes otherwise) and int4 out_features % 16 == 0, other layers dequantize
+        if self._packed is None:
+            if self.bits == 8 and self.in_features % 16 == 0 and hasattr(torch, '_weight_int8pack_mm'):
+                self._packed = (self.qweight, self.scales.to(torch.bfloat16))
+            elif self.bits == 4 and self.out_features % 16 == 0 and hasattr(torch.ops.aten, '_weight_int4pack_mm_for_cpu'):
+                packed = torch.ops.aten._convert_weight_to_int4pack_for_cpu(self._unpack().int(), 1)
+                scales_and_zeros = torch.stack((self.scales, self.zeros), dim=-1).transpose(0, 1).contiguous()
+                self._packed = (packed, scales_and_zeros.to(torch.bfloat16))
+            else:
+                self._packed = False
+        return self._packed
+
+    def _apply(self, fn, *args, **kwargs):
+        self._packed = None # device or dtype moves invalidate the packed copy
+        return super()._apply(fn, *args, **kwargs)
+
+    def forward(self, x):
+        if x.device.type == 'cpu' and self._cpu_kernel():
+            w, s = self._packed
+            x2 = x.reshape(-1, self.in_features).to(torch.bfloat16)
+            if self.bits == 8:
+                y = torch._weight_int8pack_mm(x2, w, s)
+            else:
+                y = torch.ops.aten._weight_int4pack_mm_for_cpu(x2, w, self.group_size, s)
+            y = y.view(*x.shape[:-1], self.out_features).to(x.dtype)
+            return y + self.bias.to(x.dtype) if self.bias is not None else y
+        return F.linear(x, self.dequantize().to(x.dtype), None if self.bias is None else self.bias.to(x.dtype))
+
+    def get_config(self, weight_file=None):
+        weights = {"weight": self.dequantize(), "bias": self.bias}
+        return {
+            "class_name": "Dense",
+            "config": {
+                "input_dim": self.in_features,
+                "output_dim": self.out_features,
+                "bias": self.bias is not None,
+                "activation": "linear",
+                "quantization": {"bits": self.bits, "group_size": self.group_size},
+            },
+            "weight": export_weights(weights, weight_file),
         }
 
 class CausalSelfAttention(nn.Module):
@@ -127,7 +286,7 @@ class CausalSelfAttention(nn.Module):
             self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
                                         .view(1, 1, config.block_size, config.block_size))
 
-    def forward(self, x):
+    def forward(self, x, attn_mask=None, kv_cache=None, layer_idx=0):
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
@@ -136,32 +295,51 @@ class CausalSelfAttention(nn.Module):
         q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
         v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
 
-        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
+        # with a kv cache the T new queries attend to all S cached + new keys, i.e. they sit
+        # at the bottom-right corner of the (S, S) causal mask
+        start = 0
+        if kv_cache is not None:
+            start = kv_cache.pos
+            k, v = kv_cache.update(layer_idx, k, v) # (B, nh, S, hs)
+        S = k.size(2)
+
+        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, S) -> (B, nh, T, S)
+        # an explicit boolean attn_mask (True = may attend) replaces the implicit causal mask
         if self.flash:
             # efficient attention using Flash Attention CUDA kernels
-            y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=None, dropout_p=self.dropout if self.training else 0, is_causal=True)
+            is_causal = False
+            if attn_mask is None and T > 1:
+                if start == 0:
+                    is_causal = True
+                else:
+                    attn_mask = torch.ones(T, S, dtype=torch.bool, device=x.device).tril(diagonal=start)
+            # (a single new query without an explicit mask may see every key)
+            y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=self.dropout if self.training else 0, is_causal=is_causal)
         else:
             # manual implementation of attention
             att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-            att = att.masked_fill(self.bias[:,:,:T,:T] == 0, float('-inf'))
+            if attn_mask is None:
+                att = att.masked_fill(self.bias[:,:,start:S,:S] == 0, float('-inf'))
+            else:
+                att = att.masked_fill(~attn_mask, float('-inf'))
             att = F.softmax(att, dim=-1)
             att = self.attn_dropout(att)
-            y = att @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
+            y = att @ v # (B, nh, T, S) x (B, nh, S, hs) -> (B, nh, T, hs)
         y = y.transpose(1, 2).contiguous().view(B, T, C) # re-assemble all head outputs side by side
 
         # output projection
         y = self.resid_dropout(self.c_proj(y))
         return y
     
-    def get_config(self):
+    def get_config(self, weight_file=None):
         return {
             "class_name": "CausalSelfAttention",
             "config": {
                 "n_embd": self.n_embd,
                 "n_head": self.n_head,
                 "layers": {
-                    "c_attn": self.c_attn.get_config(),
-                    "c_proj": self.c_proj.get_config(),
+                    "c_attn": self.c_attn.get_config(weight_file),
+                    "c_proj": self.c_proj.get_config(weight_file),
                 }
             }
         }
@@ -182,14 +360,14 @@ class MLP(nn.Module):
         x = self.dropout(x)
         return x
     
-    def get_config(self):
+    def get_config(self, weight_file=None):
         return {
             "class_name": "MLP",
             "config": {
                 "layers": {
-                    "c_fc": self.c_fc.get_config(),
+                    "c_fc": self.c_fc.get_config(weight_file),
                     "gelu": self.gelu.get_config(),
-                    "c_proj": self.c_proj.get_config()
+                    "c_proj": self.c_proj.get_config(weight_file)
                 }
             }
         }
@@ -203,20 +381,20 @@ class Block(nn.Module):
         self.ln_2 = LayerNorm(config.n_embd, bias=config.bias)
         self.mlp = MLP(config)
 
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
+    def forward(self, x, attn_mask=None, kv_cache=None, layer_idx=0):
+        x = x + self.attn(self.ln_1(x), attn_mask=attn_mask, kv_cache=kv_cache, layer_idx=layer_idx)
         x = x + self.mlp(self.ln_2(x))
         return x
     
-    def get_config(self):
+    def get_config(self, weight_file=None):
         return {
             "class_name": "TransformerBlock",
             "config": {
                 "layers": {
-                    "ln_1": self.ln_1.get_config(),
-                    "attn": self.attn.get_config(),
-                    "ln_2": self.ln_2.get_config(),
-                    "mlp": self.mlp.get_config(),
+                    "ln_1": self.ln_1.get_config(weight_file),
+                    "attn": self.attn.get_config(weight_file),
+                    "ln_2": self.ln_2.get_config(weight_file),
+                    "mlp": self.mlp.get_config(weight_file),
                 }
             }
         }
@@ -231,17 +409,328 @@ class GPTConfig:
     dropout: float = 0.0
     bias: bool = True # True: bias in Linears and LayerNorms, like GPT-2. False: a bit better and faster
 
+class KVCache:
+    """
+    Key/value cache for incremental decoding. Holds, for every layer, the keys and values
+    of all positions processed so far so each generation step only has to forward the
+    newest token. Buffers are allocated lazily on the first forward, so they pick up the
+    device and (autocast) dtype of the keys, with room for block_size positions.
+    """
+
+    def __init__(self, config, batch_size):
+        self.block_size = config.block_size
+        self.batch_size = batch_size
+        self.k = [None] * config.n_layer
+        self.v = [None] * config.n_layer
+        self.pos = 0 # number of positions already stored in the cache
+        # only used for batches of left-padded prompts, see set_padding()
+        self.offset = None # (B,) number of padding positions at the start of every row
+        self.mask = None # (B, block_size) False at padding positions
+
+    def update(self, layer_idx, k, v):
+        # write the new keys/values (B, nh, T, hs) in place after the cached ones and
+        # return views over the full history (B, nh, pos+T, hs)
+        B, nh, T, hs = k.size()
+        if self.k[layer_idx] is None:
+            self.k[layer_idx] = k.new_empty(B, nh, self.block_size, hs)
+            self.v[layer_idx] = v.new_empty(B, nh, self.block_size, hs)
+        end = self.pos + T
+        self.k[layer_idx][:, :, self.pos:end] = k
+        self.v[layer_idx][:, :, self.pos:end] = v
+        return self.k[layer_idx][:, :, :end], self.v[layer_idx][:, :, :end]
+
+    def reset(self):
+        # forget all cached positions, the buffers are kept around for reuse
+        self.pos = 0
+        self.offset = self.mask = None
+
+    def crop(self, pos):
+        # roll back to the first pos positions, e.g. to drop rejected draft tokens
+        self.pos = min(self.pos, pos)
+
+    def set_padding(self, pad):
+        # declare that row b starts with pad[b] padding positions (left padding). These are
+        # masked out of attention and the position ids of every row start counting after them
+        self.offset = pad
+        self.mask = torch.arange(self.block_size, device=pad.device)[None, :] >= pad[:, None]
+
+    def attn_mask(self, T):
+        # boolean mask (B, 1, T, pos+T) for the next T queries: causal and skipping padding,
+        # but always letting a position see itself so padded queries never get an empty
+        # (NaN) softmax row that would leak into the values of real tokens
+        S = self.pos + T
+        q_pos = torch.arange(self.pos, S, device=self.mask.device)[:, None]
+        k_pos = torch.arange(S, device=self.mask.device)[None, :]
+        mask = (k_pos <= q_pos) & self.mask[:, None, None, :S]
+        return mask | (k_pos == q_pos)
+
+    def select(self, rows):
+        # keep only the given batch rows (LongTensor), e.g. once the other rows are done
+        self.k = [k[rows] if k is not None else None for k in self.k]
+        self.v = [v[rows] if v is not None else None for v in self.v]
+        if self.offset is not None:
+            self.offset, self.mask = self.offset[rows], self.mask[rows]
+        self.batch_size = len(rows)
+
+    def trim(self):
+        # drop the leading positions that are padding in every row to make room at the end,
+        # returns the number of positions freed. Position ids are relative to the padding,
+        # so the cached keys/values stay valid
+        if self.offset is None:
+            return 0
+        n = int(self.offset.min())
+        if n == 0:
+            return 0
+        for k, v in zip(self.k, self.v):
+            if k is not None:
+                k[:, :, :self.pos - n] = k[:, :, n:self.pos].clone()
+                v[:, :, :self.pos - n] = v[:, :, n:self.pos].clone()
+        self.mask[:, :self.pos - n] = self.mask[:, n:self.pos].clone()
+        self.mask[:, self.pos - n:] = True
+        self.offset = self.offset - n
+        self.pos -= n
+        return n
+
+    def pad_left(self, n):
+        # shift every row n positions to the right, turning the freed positions into padding
+        if n == 0:
+            return
+        assert self.pos + n <= self.block_size
+        if self.offset is None:
+            self.set_padding(torch.zeros(self.batch_size, dtype=torch.long, device=self.k[0].device))
+        for k, v in zip(self.k, self.v):
+            k[:, :, n:self.pos + n] = k[:, :, :self.pos].clone()
+            v[:, :, n:self.pos + n] = v[:, :, :self.pos].clone()
+            # zero the padding, uninitialized memory could hold NaNs that leak through the mask
+            k[:, :, :n] = 0
+            v[:, :, :n] = 0
+        self.mask[:, n:self.pos + n] = self.mask[:, :self.pos].clone()
+        self.mask[:, :n] = False
+        self.offset = self.offset + n
+        self.pos += n
+
+    def extend(self, other):
+        # append the rows of another cache to this one. The rows are aligned on their last
+        # position (the shorter side gets left-padded) so the next step writes at the same
+        # position for every row
+        if other.batch_size == 0:
+            return
+        if self.batch_size == 0:
+            self.k, self.v, self.pos = other.k, other.v, other.pos
+            self.offset, self.mask, self.batch_size = other.offset, other.mask, other.batch_size
+            return
+        if other.pos > self.pos:
+            self.pad_left(other.pos - self.pos)
+        else:
+            other.pad_left(self.pos - other.pos)
+        for cache in (self, other):
+            if cache.offset is None:
+                cache.set_padding(torch.zeros(cache.batch_size, dtype=torch.long, device=cache.k[0].device))
+        self.k = [torch.cat((a, b)) for a, b in zip(self.k, other.k)]
+        self.v = [torch.cat((a, b)) for a, b in zip(self.v, other.v)]
+        self.offset = torch.cat((self.offset, other.offset))
+        self.mask = torch.cat((self.mask, other.mask))
+        self.batch_size += other.batch_size
+
+# -----------------------------------------------------------------------------
+# sampling: a pipeline of logits processors followed by a draw from the distribution
+#
+# every processor is a callable processor(scores, ids, idx) -> (scores, ids) that works in place:
+# scores are the (b, n) logits, either over the whole vocabulary in vocab order (ids is None) or
+# over a set of candidates sorted in descending order whose vocab ids are held in ids (b, n).
+# idx (b, t) are the token ids seen so far (-1 marks padding), only used by the penalties.
+# narrowing to candidates early (top-k, top-p) keeps the remaining work off the full vocabulary.
+
+def _history(idx):
+    # replace the padding in idx by a real token of the same row: gather/scatter then read and
+    # write the same value twice, which is harmless. also returns the mask of real positions
+    valid = idx >= 0
+    return torch.where(valid, idx, idx.max(dim=-1, keepdim=True).values), valid
+
+def _topk_until(scores, enough, k=64):
+    # top-k candidates of growing size until enough(values) holds for every row, so that the
+    # whole vocabulary rarely has to be sorted
+    n = scores.size(-1)
+    k = min(k, n)
+    while True:
+        vals, pos = torch.topk(scores, k) # sorted
+        if k == n or bool(enough(vals).all()):
+            return vals, pos
+        k = min(4 * k, n)
+
+class RepetitionPenalty:
+    """ CTRL-style penalty (https://arxiv.org/abs/1909.05858): divide positive / multiply negative logits of seen tokens """
+    uses_history = True
+
+    def __init__(self, penalty):
+        self.penalty = penalty
+
+    def __call__(self, scores, ids, idx):
+        assert ids is None, "penalties have to run on the full vocabulary, before top-k/top-p"
+        hist, _ = _history(idx)
+        score = scores.gather(-1, hist)
+        scores.scatter_(-1, hist, torch.where(score > 0, score / self.penalty, score * self.penalty))
+        return scores, ids
+
+class FrequencyPenalty:
+    """ OpenAI-style penalties: subtract frequency * count and presence * (count > 0) from the logits of seen tokens """
+    uses_history = True
+
+    def __init__(self, frequency=0.0, presence=0.0):
+        self.frequency = frequency
+        self.presence = presence
+
+    def __call__(self, scores, ids, idx):
+        assert ids is None, "penalties have to run on the full vocabulary, before top-k/top-p"
+        hist, valid = _history(idx)
+        if self.presence:
+            scores.scatter_(-1, hist, scores.gather(-1, hist) - self.presence)
+        if self.frequency:
+            # duplicates accumulate, so every occurrence is subtracted once
+            scores.scatter_add_(-1, hist, valid.to(scores.dtype) * -self.frequency)
+        return scores, ids
+
+class Temperature:
+    """ scale the logits by 1/temperature (a float, or a (b, 1) tensor with one per row) """
+    uses_history = False
+
+    def __init__(self, temperature):
+        self.temperature = temperature
+
+    def __call__(self, scores, ids, idx):
+        scores.div_(self.temperature)
+        return scores, ids
+
+class TopK:
+    """ keep only the k most likely tokens """
+    uses_history = False
+
+    def __init__(self, k):
+        self.k = k
+
+    def __call__(self, scores, ids, idx):
+        if self.k >= scores.size(-1):
+            return scores, ids
+        scores, pos = torch.topk(scores, self.k) # sorted
+        return scores, (pos if ids is None else ids.gather(-1, pos))
+
+class TopP:
+    """ nucleus sampling (https://arxiv.org/abs/1904.09751): keep the smallest set of tokens with probability mass >= p """
+    uses_history = False
+
+    def __init__(self, p, min_candidates=64):
+        self.p = p
+        self.min_candidates = min_candidates
+
+    def __call__(self, scores, ids, idx):
+        lse = torch.logsumexp(scores, dim=-1, keepdim=True)
+        if ids is None:
+            # narrow down to candidates that hold the nucleus
+            scores, ids = _topk_until(scores, lambda vals: (vals - lse).exp().sum(-1) >= self.p, self.min_candidates)
+        probs = (scores - lse).exp()
+        # drop a token when the tokens before it already reach p, so the first one is always kept
+        scores.masked_fill_(probs.cumsum(-1) - probs >= self.p, float('-inf'))
+        return scores, ids
+
+class MinP:
+    """ min-p sampling (https://arxiv.org/abs/2407.01082): keep tokens with probability > p * (max probability) """
+    uses_history = False
+
+    def __init__(self, p, min_candidates=64):
+        assert 0.0 < p < 1.0
+        self.p = p
+        self.min_candidates = min_candidates
+
+    def __call__(self, scores, ids, idx):
+        # the cutoff in logit space is max + log(p)
+        cutoff = scores.max(dim=-1, keepdim=True).values + math.log(self.p)
+        if ids is None:
+            # narrow down to candidates that include every token above the cutoff
+            scores, ids = _topk_until(scores, lambda vals: vals[:, -1:] <= cutoff, self.min_candidates)
+        # shifting every row so the cutoff sits at 0 (softmax doesn't care) lets one scalar
+        # in-place threshold do the masking
+        scores.sub_(cutoff)
+        F.threshold_(scores, 0.0, float('-inf'))
+        return scores, ids
+
+class Sampler:
+    """
+    Turns the final-step logits (b, vocab_size) into the next token ids (b, 1), through the usual
+    processors (in this order: penalties, top-k, temperature, top-p, min-p) followed by any custom
+    ones, then sampling. temperature=0 means greedy decoding. The logits are modified in place.
+    """
+
+    def __init__(self, temperature=1.0, top_k=None, top_p=None, min_p=None, repetition_penalty=1.0,
+                 frequency_penalty=0.0, presence_penalty=0.0, processors=()):
+        self.greedy = not torch.is_tensor(temperature) and temperature == 0
+        self.processors = []
+        if repetition_penalty != 1.0:
+            self.processors.append(RepetitionPenalty(repetition_penalty))
+        if frequency_penalty or presence_penalty:
+            self.processors.append(FrequencyPenalty(frequency_penalty, presence_penalty))
+        if top_k:
+            # top-k before temperature: it doesn't change the order, and is cheaper on k candidates
+            self.processors.append(TopK(top_k))
+        if not self.greedy:
+            if torch.is_tensor(temperature) or temperature != 1.0:
+                self.processors.append(Temperature(temperature))
+            if top_p is not None and top_p < 1.0:
+                self.processors.append(TopP(top_p))
+            if min_p:
+                self.processors.append(MinP(min_p))
+        self.processors.extend(processors)
+        self.uses_history = any(p.uses_history for p in self.processors)
+
+    def process(self, logits, idx=None):
+        # run the processors, returns the final scores and their vocab ids (None: whole vocabulary)
+        scores, ids = logits, None
+        for processor in self.processors:
+            scores, ids = processor(scores, ids, idx)
+        return scores, ids
+
+    def distribution(self, logits, idx=None):
+        # the full (b, vocab_size) probability distribution the next tokens would be sampled from
+        scores, ids = self.process(logits, idx)
+        if self.greedy:
+            probs = torch.zeros_like(scores, dtype=torch.float32)
+            probs.scatter_(-1, scores.argmax(dim=-1, keepdim=True), 1.0)
+        else:
+            probs = F.softmax(scores.float(), dim=-1)
+        if ids is None:
+            return probs
+        return torch.zeros(logits.shape, dtype=probs.dtype, device=probs.device).scatter_(-1, ids, probs)
+
+    def __call__(self, logits, idx=None, return_logprobs=False):
+        scores, ids = self.process(logits, idx)
+        if self.greedy:
+            choice = scores.argmax(dim=-1, keepdim=True)
+            logprobs = torch.zeros(choice.shape, device=scores.device)
+        else:
+            # unnormalized probabilities, in place: multinomial doesn't need them to sum to 1
+            probs = scores.sub_(scores.max(dim=-1, keepdim=True).values).exp_()
+            choice = torch.multinomial(probs, num_samples=1)
+            if return_logprobs:
+                logprobs = torch.log(probs.gather(-1, choice) / probs.sum(dim=-1, keepdim=True))
+        idx_next = choice if ids is None else ids.gather(-1, choice)
+        if return_logprobs:
+            return idx_next, logprobs
+        return idx_next
+
 class GPT(nn.Module):
 
-    def __init__(self, config):
+    def __init__(self, config, skip_init=False):
         super().__init__()
         assert config.vocab_size is not None
         assert config.block_size is not None
         self.config = config
+        # skip_init is for callers that assign every weight afterwards (from_checkpoint, from_export build the
+        # model on the meta device): there is nothing to initialize, and skipping it also skips a slow
+        # first-time import behind normal_() on meta tensors
+        empty = lambda *shape: torch.empty(*shape) if skip_init else None # an explicit weight makes nn.Embedding skip its init
 
         self.transformer = nn.ModuleDict(dict(
-            wte = nn.Embedding(config.vocab_size, config.n_embd),
-            wpe = nn.Embedding(config.block_size, config.n_embd),
+            wte = nn.Embedding(config.vocab_size, config.n_embd, _weight=empty(config.vocab_size, config.n_embd)),
+            wpe = nn.Embedding(config.block_size, config.n_embd, _weight=empty(config.block_size, config.n_embd)),
             drop = nn.Dropout(config.dropout),
             h = nn.ModuleList([Block(config) for _ in range(config.n_layer)]),
             ln_f = LayerNorm(config.n_embd, bias=config.bias),
@@ -254,11 +743,12 @@ class GPT(nn.Module):
         self.transformer.wte.weight = self.lm_head.weight # https://paperswithcode.com/method/weight-tying
 
         # init all weights
-        self.apply(self._init_weights)
-        # apply special scaled init to the residual projections, per GPT-2 paper
-        for pn, p in self.named_parameters():
-            if pn.endswith('c_proj.weight'):
-                torch.nn.init.normal_(p, mean=0.0, std=0.02/math.sqrt(2 * config.n_layer))
+        if not skip_init:
+            self.apply(self._init_weights)
+            # apply special scaled init to the residual projections, per GPT-2 paper
+            for pn, p in self.named_parameters():
+                if pn.endswith('c_proj.weight'):
+                    torch.nn.init.normal_(p, mean=0.0, std=0.02/math.sqrt(2 * config.n_layer))
 
         # report number of parameters
         print("number of parameters: %.2fM" % (self.get_num_params()/1e6,))
@@ -283,24 +773,46 @@ class GPT(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def forward(self, idx, targets=None):
+    def forward(self, idx, targets=None, kv_cache=None, all_logits=False, doc_ids=None):
         device = idx.device
         b, t = idx.size()
-        assert t <= self.config.block_size, f"Cannot forward sequence of length {t}, block size is only {self.config.block_size}"
-        pos = torch.arange(0, t, dtype=torch.long, device=device) # shape (t)
+        # with a kv cache, idx holds only the new tokens that follow the cached positions
+        start = kv_cache.pos if kv_cache is not None else 0
+        assert start + t <= self.config.block_size, f"Cannot forward sequence of length {start + t}, block size is only {self.config.block_size}"
+        pos = torch.arange(start, start + t, dtype=torch.long, device=device) # shape (t)
+        attn_mask = None
+        if kv_cache is not None and kv_cache.offset is not None:
+            # left-padded rows: positions count from each row's first real token
+            pos = (pos[None, :] - kv_cache.offset[:, None]).clamp(min=0) # shape (b, t)
+            attn_mask = kv_cache.attn_mask(t)
+        if doc_ids is not None:
+            # packed documents (see dataloader.py): every token attends causally within its own
+            # document only, and positions restart at 0 at the first token of every document
+            assert kv_cache is None, "doc_ids are for training on packed rows"
+            new_doc = torch.ones_like(doc_ids, dtype=torch.bool)
+            new_doc[:, 1:] = doc_ids[:, 1:] != doc_ids[:, :-1]
+            doc_start = torch.where(new_doc, pos, 0).cummax(dim=1).values
+            pos = pos - doc_start # shape (b, t)
+            attn_mask = (doc_ids[:, :, None] == doc_ids[:, None, :]).tril()[:, None] # (b, 1, t, t)
 
         # forward the GPT model itself
         tok_emb = self.transformer.wte(idx) # token embeddings of shape (b, t, n_embd)
-        pos_emb = self.transformer.wpe(pos) # position embeddings of shape (t, n_embd)
+        pos_emb = self.transformer.wpe(pos) # position embeddings of shape (t, n_embd) or (b, t, n_embd)
         x = self.transformer.drop(tok_emb + pos_emb)
-        for block in self.transformer.h:
-            x = block(x)
+        for i, block in enumerate(self.transformer.h):
+            x = block(x, attn_mask=attn_mask, kv_cache=kv_cache, layer_idx=i)
         x = self.transformer.ln_f(x)
+        if kv_cache is not None:
+            kv_cache.pos += t
 
         if targets is not None:
             # if we are given some desired targets also calculate the loss
             logits = self.lm_head(x)
             loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1)
+        elif all_logits:
+            # inference that needs the predictions at every position, e.g. to verify draft tokens
+            logits = self.lm_head(x)
+            loss = None
         else:
             # inference-time mini-optimization: only forward the lm_head on the very last position
             logits = self.lm_head(x[:, [-1], :]) # note: using list [-1] to preserve the time dim
@@ -319,6 +831,45 @@ class GPT(nn.Module):
             if hasattr(block.attn, 'bias'):
                 block.attn.bias = block.attn.bias[:,:,:block_size,:block_size]
 
+    @torch.no_grad()
+    def quantize(self, bits=8, group_size=64):
+        # model surgery for inference: swap every nn.Linear (c_attn, c_proj, c_fc, lm_head) for a
+        # weight-only QuantizedLinear. the tied token embedding keeps its own float copy of the weight
+        self.transformer.wte.weight = nn.Parameter(self.transformer.wte.weight.detach().clone())
+        for module in list(self.modules()):
+            for name, child in list(module.named_children()):
+                if isinstance(child, nn.Linear):
+                    setattr(module, name, QuantizedLinear.from_linear(child, bits, group_size))
+        self.quantization = dict(bits=bits, group_size=group_size)
+        return self
+
+    @classmethod
+    def from_checkpoint(cls, ckpt_path, device='cpu', override_args=None):
+        """
+        Load a GPT from a checkpoint written by train.py (or quantize.py), returning the model and the
+        checkpoint dict. The checkpoint is memory-mapped instead of read, the model is built on the meta
+        device so no weights get initialized just to be overwritten, and the mapped tensors become the
+        parameters as they are, so on the CPU startup costs little more than the page faults of the
+        weights as they get used. override_args can change e.g. the dropout of the config.
+        """
+        checkpoint = torch.load(ckpt_path, map_location='cpu', mmap=True)
+        state_dict = checkpoint['model']
+        # fix the keys of the state dictionary, compiled models save theirs with this prefix
+        unwanted_prefix = '_orig_mod.'
+        for k,v in list(state_dict.items()):
+            if k.startswith(unwanted_prefix):
+                state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
+        model_args = dict(checkpoint['model_args'], **(override_args or {}))
+        with torch.device('meta'):
+            model = cls(GPTConfig(**model_args), skip_init=True)
+            if 'quantization' in checkpoint:
+                model.quantize(**checkpoint['quantization'])
+        model.load_state_dict(state_dict, assign=True)
+        if 'quantization' not in checkpoint:
+            model.transformer.wte.weight = model.lm_head.weight # assign=True replaced the tied parameter, tie it again
+        model.to(device)
+        return model, checkpoint
+
     @classmethod
     def from_pretrained(cls, model_type, override_args=None):
         assert model_type in {'gpt2', 'gpt2-medium', 'gpt2-large', 'gpt2-xl'}
@@ -419,35 +970,204 @@ class GPT(nn.Module):
         return mfu
 
     @torch.no_grad()
-    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None):
+    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None, use_kv_cache=False, sampler=None):
         """
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
         Most likely you'll want to make sure to be in model.eval() mode of operation for this.
+        With use_kv_cache=True the keys/values of past positions are cached and every step only
+        forwards the newest token. Once the cache holds block_size positions it slides: the cache
+        is dropped and rebuilt from the most recent block_size // 2 tokens, so the context seen by
+        the model varies between half a block and a full block instead of always being a full one.
+        Pass a Sampler for more sampling options than temperature and top_k (top-p, min-p, penalties).
         """
-        for _ in range(max_new_tokens):
-            # if the sequence context is growing too long we must crop it at block_size
-            idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self.config.block_size:]
-            # forward the model to get the logits for the index in the sequence
-            logits, _ = self(idx_cond)
-            # pluck the logits at the final step and scale by desired temperature
-            logits = logits[:, -1, :] / temperature
-            # optionally crop the logits to only the top k options
-            if top_k is not None:
-                v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-                logits[logits < v[:, [-1]]] = -float('Inf')
-            # apply softmax to convert logits to (normalized) probabilities
-            probs = F.softmax(logits, dim=-1)
-            # sample from the distribution
-            idx_next = torch.multinomial(probs, num_samples=1)
+        for idx_next in self.generate_stream(idx, max_new_tokens, temperature, top_k, use_kv_cache, sampler=sampler):
             # append sampled index to the running sequence and continue
             idx = torch.cat((idx, idx_next), dim=1)
 
         return idx
 
-    def get_config(self):
+    @torch.no_grad()
+    def generate_stream(self, idx, max_new_tokens, temperature=1.0, top_k=None, use_kv_cache=False, return_logprobs=False, sampler=None):
+        """
+        Generator version of generate(): yields the sampled indices (LongTensor of shape (b,1))
+        of every step as soon as they are produced, instead of returning the completed sequence
+        at the end. With return_logprobs=True it yields (indices, logprobs) pairs instead, the
+        log probabilities (b,1) of the sampled indices under the (tempered, top_k) distribution.
+        """
+        sampler = sampler or Sampler(temperature, top_k)
+        block_size = self.config.block_size
+        kv_cache = KVCache(self.config, idx.size(0)) if use_kv_cache else None
+        for _ in range(max_new_tokens):
+            if kv_cache is None:
+                # if the sequence context is growing too long we must crop it at block_size
+                idx_cond = idx if idx.size(1) <= block_size else idx[:, -block_size:]
+            elif kv_cache.pos == 0:
+                # prefill the cache with the (cropped) prompt
+                idx_cond = idx[:, -block_size:]
+            elif kv_cache.pos == block_size:
+                # out of positions: slide the window, re-encoding the most recent half block
+                kv_cache.reset()
+                idx_cond = idx[:, -max(block_size // 2, 1):]
+            else:
+                # everything but the token sampled last is already in the cache
+                idx_cond = idx[:, -1:]
+            # forward the model to get the logits for the index in the sequence
+            logits, _ = self(idx_cond, kv_cache=kv_cache)
+            # pluck the logits at the final step and sample the next index
+            out = sampler(logits[:, -1, :], idx, return_logprobs=return_logprobs)
+            yield out
+            idx_next = out[0] if return_logprobs else out
+            idx = torch.cat((idx, idx_next), dim=1)
+
+    @torch.no_grad()
+    def generate_batch(self, prompts, max_new_tokens, temperature=1.0, top_k=None, eot_token=None, sampler=None):
+        """
+        Complete a list of prompts (lists of token ids, possibly of different lengths) in one
+        batch. The prompts are left-padded and masked so every step is a single forward over all
+        unfinished rows, using the kv cache. A row is retired as soon as it samples eot_token
+        (if given) or has produced its max_new_tokens (an int, or a list with one per prompt),
+        after which it no longer costs any compute. Returns a list with the new token ids of
+        every prompt, including the final eot_token if one was hit.
+        """
+        assert all(len(p) > 0 for p in prompts), "prompts must not be empty"
+        sampler = sampler or Sampler(temperature, top_k)
+        device = self.transformer.wte.weight.device
+        block_size = self.config.block_size
+        if isinstance(max_new_tokens, int):
+            max_new_tokens = [max_new_tokens] * len(prompts)
+        seqs = [list(p) for p in prompts] # full token history of every row
+        out = [[] for _ in prompts]
+        active = [i for i, n in enumerate(max_new_tokens) if n > 0] # prompts still generating
+        kv_cache = KVCache(self.config, len(active))
+        idx_next = None
+        while active:
+            if kv_cache.pos == block_size:
+                # out of positions: first reclaim padding shared by all rows...
+                kv_cache.trim()
+            if kv_cache.pos in (0, block_size):
+                # ...else (re)fill the cache with the most recent tokens of every row.
+                # like generate(), the window slides by re-encoding the last half block
+                window = block_size if kv_cache.pos == 0 else max(block_size // 2, 1)
+                logits = self.prefill([seqs[i][-window:] for i in active], kv_cache)
+            else:
+                logits, _ = self(idx_next, kv_cache=kv_cache)
+            hist = None
+            if sampler.uses_history:
+                # token history of every row for the penalties, left-padded with -1
+                T = max(len(seqs[i]) for i in active)
+                hist = torch.tensor([[-1] * (T - len(seqs[i])) + seqs[i] for i in active], dtype=torch.long, device=device)
+            idx_next = sampler(logits[:, -1, :], hist)
+            # bookkeeping on the host, retiring finished rows from the batch
+            keep = []
+            for row, (i, tok) in enumerate(zip(active, idx_next.view(-1).tolist())):
+                seqs[i].append(tok)
+                out[i].append(tok)
+                if tok != eot_token and len(out[i]) < max_new_tokens[i]:
+                    keep.append(row)
+            if len(keep) < len(active):
+                active = [active[row] for row in keep]
+                if active:
+                    rows = torch.tensor(keep, dtype=torch.long, device=device)
+                    kv_cache.select(rows)
+                    idx_next = idx_next[rows]
+
+        return out
+
+    @torch.no_grad()
+    def generate_speculative(self, idx, draft_model, max_new_tokens, num_draft=4, temperature=1.0, top_k=None, sampler=None):
+        """
+        Speculative decoding (https://arxiv.org/abs/2211.17192, https://arxiv.org/abs/2302.01318):
+        a small draft_model (a GPT with the same vocabulary) proposes num_draft tokens one by one,
+        and this model scores all of them in a single forward. Draft token i is accepted with
+        probability min(1, p_i / q_i) (p this model's, q the draft's probability of it); at the
+        first rejection a replacement is sampled from max(0, p - q) renormalized, and if all are
+        accepted a bonus token is sampled from p. The output follows exactly the distribution of
+        sampling from this model alone, at the cost of about one forward of it per accepted run.
+        That holds while the sequence fits in block_size (the smaller one of the two models):
+        past it, the caches slide by re-encoding the last half block too, but up to num_draft
+        positions early and so at other points than generate(use_kv_cache=True), and the context
+        the tokens are sampled from differs from generate's.
+        Only a single sequence (b=1) is supported. Returns the completed sequence and a dict of
+        stats, including the acceptance rate of the drafted tokens.
+        """
+        assert idx.size(0) == 1, "speculative decoding supports a single sequence"
+        assert draft_model.config.vocab_size == self.config.vocab_size, "the draft model needs the same vocabulary"
+        sampler = sampler or Sampler(temperature, top_k)
+        block_size = min(self.config.block_size, draft_model.config.block_size)
+        assert num_draft < block_size // 2, "num_draft has to fit into half a block"
+        device = idx.device
+        seq = idx[0].tolist()
+        n_prompt = len(seq)
+        # the caches hold positions seq[base:], the tokens not cached yet are fed at the next forward
+        base = max(0, len(seq) - (block_size - num_draft))
+        cache, draft_cache = KVCache(self.config, 1), KVCache(draft_model.config, 1)
+        stats = {'rounds': 0, 'drafted': 0, 'accepted': 0}
+        while len(seq) - n_prompt < max_new_tokens:
+            k = min(num_draft, max_new_tokens - (len(seq) - n_prompt) - 1) # no use drafting past the end
+            if len(seq) - base + k > block_size:
+                # out of positions: slide the window, re-encoding the most recent half block
+                base = len(seq) - block_size // 2
+                cache.reset()
+                draft_cache.reset()
+            # draft k tokens autoregressively with the small model, keeping their distributions q
+            drafts, q = [], []
+            for _ in range(k):
+                feed = (seq + drafts)[base + draft_cache.pos:]
+                logits, _ = draft_model(torch.tensor([feed], dtype=torch.long, device=device), kv_cache=draft_cache)
+                hist = torch.tensor([seq + drafts], dtype=torch.long, device=device) if sampler.uses_history else None
+                q.append(sampler.distribution(logits[:, -1, :], hist)[0])
+                drafts.append(torch.multinomial(q[-1], num_samples=1).item())
+            # score all drafts with one forward of this model, p[i] is its distribution for drafts[i]
+            feed = (seq + drafts)[base + cache.pos:]
+            logits, _ = self(torch.tensor([feed], dtype=torch.long, device=device), kv_cache=cache, all_logits=True)
+            logits = logits[0, -(k + 1):, :]
+            accepted = 0
+            for i in range(k + 1):
+                hist = torch.tensor([seq + drafts[:i]], dtype=torch.long, device=device) if sampler.uses_history else None
+                p = sampler.distribution(logits[[i]], hist)[0]
+                if i == k:
+                    # every draft was accepted: the bonus token comes from this model's distribution
+                    tok = torch.multinomial(p, num_samples=1).item()
+                    break
+                d = drafts[i]
+                if torch.rand(1).item() < p[d].item() / q[i][d].item():
+                    accepted += 1
+                    continue
+                # rejected: resample from the part of p that the draft distribution under-covers
+                residual = (p - q[i]).clamp_(min=0)
+                tok = torch.multinomial(residual if residual.sum() > 0 else p, num_samples=1).item()
+                break
+            seq += drafts[:accepted] + [tok]
+            # roll the caches back to the accepted tokens, the last token is fed next round
+            cache.crop(len(seq) - 1 - base)
+            draft_cache.crop(len(seq) - 1 - base)
+            stats['rounds'] += 1
+            stats['drafted'] += k
+            stats['accepted'] += accepted
+        stats['acceptance_rate'] = stats['accepted'] / max(stats['drafted'], 1)
+        stats['tokens_per_round'] = (len(seq) - n_prompt) / max(stats['rounds'], 1)
+        return torch.tensor([seq[:n_prompt + max_new_tokens]], dtype=torch.long, device=device), stats
+
+    @torch.no_grad()
+    def prefill(self, seqs, kv_cache):
+        """
+        Reset kv_cache and encode the token lists in seqs (one per row, at most block_size long)
+        into it as one left-padded batch. Returns the logits (b, 1, vocab_size) at the last
+        position of every row, from which the first new tokens can be sampled.
+        """
+        device = self.transformer.wte.weight.device
+        T = max(len(seq) for seq in seqs)
+        idx = torch.tensor([[0] * (T - len(seq)) + list(seq) for seq in seqs], dtype=torch.long, device=device)
+        kv_cache.reset()
+        kv_cache.set_padding(torch.tensor([T - len(seq) for seq in seqs], dtype=torch.long, device=device))
+        logits, _ = self(idx, kv_cache=kv_cache)
+        return logits
+
+    def get_config(self, weight_file=None):
         return {
             "model_name": "eaiGPT",
+            "model_args": asdict(self.config),
             "layers": {
                 "input": {
                     "class_name": "InputLayer",
@@ -455,10 +1175,63 @@ class GPT(nn.Module):
                         "input_shape": [None],
                     }
                 },
-                "wte": self.transformer.wte.get_config(),
-                "wpe": self.transformer.wpe.get_config(),
-                "blocks": [block.get_config() for block in self.transformer.h],
-                "ln_f": self.transformer.ln_f.get_config(),
-                "lm_head": self.lm_head.get_config(),
+                "wte": self.transformer.wte.get_config(weight_file),
+                "wpe": self.transformer.wpe.get_config(weight_file),
+                "blocks": [block.get_config(weight_file) for block in self.transformer.h],
+                "ln_f": self.transformer.ln_f.get_config(weight_file),
+                "lm_head": self.lm_head.get_config(weight_file),
             }
         }
+
+    def export(self, manifest_path, blob_path):
+        # full-weight export: the get_config() tree as a json manifest plus all weights in one binary blob
+        root = os.path.dirname(os.path.abspath(manifest_path))
+        with WeightFile(blob_path, relative_to=root) as f:
+            config = self.get_config(f)
+        with open(manifest_path, 'w') as f:
+            json.dump(config, f, indent=2)
+
+    @classmethod
+    def from_export(cls, manifest_path):
+        """
+        Rebuild a GPT from a manifest and weight blob written by GPT.export. The blob is memory-mapped
+        copy-on-write and the parameters are views into it, so no weight is read or decoded up front.
+        """
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        root = os.path.dirname(os.path.abspath(manifest_path))
+        blobs = {}
+        state_dict = {}
+        def collect(layer, prefix):
+            weight = layer.get('weight')
+            if weight is not None:
+                assert weight['type'] == 'file', "the manifest has no weights, export it with a WeightFile"
+                assert weight['byteorder'] == 'little'
+                if weight['path'] not in blobs:
+                    blobs[weight['path']] = np.memmap(os.path.join(root, weight['path']), dtype=np.uint8, mode='c')
+                blob = blobs[weight['path']]
+                for name, t in weight['tensors'].items():
+                    assert t['dtype'] == 'float32'
+                    buf = blob[t['offset']:t['offset'] + t['nbytes']].view('<f4').reshape(t['shape'])
+                    state_dict[prefix + name] = torch.from_numpy(buf)
+            for name, sublayer in layer.get('config', {}).get('layers', {}).items():
+                collect(sublayer, prefix + name + '.')
+        layers = manifest['layers']
+        for name, prefix in [('wte', 'transformer.wte.'), ('wpe', 'transformer.wpe.'), ('ln_f', 'transformer.ln_f.'), ('lm_head', 'lm_head.')]:
+            collect(layers[name], prefix)
+        for i, block in enumerate(layers['blocks']):
+            collect(block, f'transformer.h.{i}.')
+
+        config = GPTConfig(**manifest['model_args'])
+        with torch.device('meta'):
+            model = cls(config, skip_init=True)
+        missing, unexpected = model.load_state_dict(state_dict, strict=False, assign=True)
+        assert not unexpected and all(k.endswith('.attn.bias') for k in missing), (missing, unexpected) # only the causal mask buffer is not exported
+        for block in model.transformer.h:
+            if hasattr(block.attn, 'bias'):
+                block.attn.bias = torch.tril(torch.ones(config.block_size, config.block_size)).view(1, 1, config.block_size, config.block_size)
+        # re-tie if both point at the same bytes of the blob, a quantized model exported its own copy of wte
+        wte, lm_head = (layers[name]['weight'] for name in ('wte', 'lm_head'))
+        if (wte['path'], wte['tensors']['weight']['offset']) == (lm_head['path'], lm_head['tensors']['weight']['offset']):
+            model.transformer.wte.weight = model.lm_head.weight
+        return model
@@ -0,0 +1,104 @@
+"""
+Post-training weight-only quantization of a trained checkpoint for CPU inference.
+Converts every nn.Linear of the model (c_attn, c_proj, c_fc, lm_head) to int8 (per output channel)
+or int4 (group-wise) weights, saves the result next to the original as ckpt_int8.pt / ckpt_int4.pt,
+and reports weight size, perplexity on val.bin and decode speed against the float model:
+$ python quantize.py --out_dir=out-shakespeare-char --formats=int8,int4
+The saved checkpoints are picked up by sample.py with --quantization=int8 (or int4).
+"""
+import os
+import time
+import math
+import numpy as np
+import torch
+from model import GPT, QuantizedLinear
+from dataloader import dataset_meta
+
+# -----------------------------------------------------------------------------
+out_dir = 'out'
+formats = 'int8,int4' # comma separated list of int8 and/or int4
+group_size = 64 # number of input features that share a scale and offset in int4: 32, 64, 128 or 256
+eval_tokens = 65536 # perplexity is measured on the first eval_tokens tokens of val.bin
+batch_size = 8 # sequences per forward pass during the perplexity evaluation
+max_new_tokens = 128 # tokens decoded (batch size 1, kv cache) for the speed measurement
+save = True # write ckpt_<format>.pt to out_dir
+seed = 1337
+device = 'cpu' # the int8/int4 kernels are CPU kernels, other devices dequantize on the fly
+compile = False
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+torch.manual_seed(seed)
+torch.set_grad_enabled(False)
+
+ckpt_path = os.path.join(out_dir, 'ckpt.pt')
+
+def load_float():
+    model, checkpoint = GPT.from_checkpoint(ckpt_path, device)
+    model.eval()
+    return model, checkpoint
+
+_, checkpoint = load_float()
+
+# the evaluation data: consecutive, non-overlapping windows of val.bin, the same for every model
+block_size = checkpoint['model_args']['block_size']
+data_dir = os.path.join('data', checkpoint['config']['dataset'])
+data = np.memmap(os.path.join(data_dir, 'val.bin'), dtype=dataset_meta(data_dir)['dtype'], mode='r')
+n_windows = max(1, min(eval_tokens, len(data) - 1) // block_size)
+starts = np.arange(n_windows) * block_size
+
+def perplexity(model):
+    total, count = 0.0, 0
+    for i in range(0, n_windows, batch_size):
+        ix = starts[i:i+batch_size]
+        x = torch.stack([torch.from_numpy(data[j:j+block_size].astype(np.int64)) for j in ix]).to(device)
+        y = torch.stack([torch.from_numpy(data[j+1:j+1+block_size].astype(np.int64)) for j in ix]).to(device)
+        _, loss = model(x, y)
+        total += loss.item() * y.numel()
+        count += y.numel()
+    return math.exp(total / count)
+
+def decode_speed(model):
+    x = torch.from_numpy(data[:8].astype(np.int64))[None].to(device)
+    n = min(max_new_tokens, block_size - x.size(1))
+    model.generate(x, 4, temperature=0.0, use_kv_cache=True) # burn in
+    t0 = time.time()
+    model.generate(x, n, temperature=0.0, use_kv_cache=True)
+    return n / (time.time() - t0)
+
+def weight_bytes(model):
+    # bytes of all the linear layer weights, the part quantization shrinks
+    n = 0
+    for m in model.modules():
+        if isinstance(m, QuantizedLinear):
+            n += sum(t.numel() * t.element_size() for t in (m.qweight, m.scales, m.zeros) if t is not None)
+        elif isinstance(m, torch.nn.Linear):
+            n += m.weight.numel() * m.weight.element_size()
+    return n
+
+results = []
+for fmt in ['float32'] + [f for f in formats.split(',') if f]:
+    model, _ = load_float()
+    if fmt != 'float32':
+        bits = {'int8': 8, 'int4': 4}[fmt]
+        model.quantize(bits, group_size)
+        if save:
+            save_path = os.path.join(out_dir, f'ckpt_{fmt}.pt')
+            print(f"saving {save_path}")
+            torch.save({
+                'model': model.state_dict(),
+                'model_args': checkpoint['model_args'],
+                'config': checkpoint.get('config', {}),
+                'quantization': model.quantization,
+            }, save_path)
+    if compile:
+        model = torch.compile(model)
+    ppl = perplexity(model)
+    tps = decode_speed(model)
+    results.append((fmt, weight_bytes(model), ppl, tps))
+    print(f"{fmt}: val perplexity {ppl:.4f}, {tps:.1f} tokens/sec")
+
+print(f"\nperplexity on {n_windows * block_size} tokens of {data_dir}/val.bin, decode speed at batch size 1 on {device}")
+print(f"{'format':>8} | {'linear weights':>14} | {'perplexity':>10} | {'tokens/sec':>10} | {'speedup':>7}")
+for fmt, nbytes, ppl, tps in results:
+    print(f"{fmt:>8} | {nbytes/1e6:>11.2f} MB | {ppl:>10.4f} | {tps:>10.1f} | {tps/results[0][3]:>6.2f}x")
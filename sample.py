@@ -2,11 +2,13 @@
 Sample from a trained model
 """
 import os
+import time
 import pickle
 from contextlib import nullcontext
 import torch
 import tiktoken
-from model import GPTConfig, GPT
+from model import GPT, Sampler
+from tokenizer.incremental import IncrementalDecoder
 import json
 
 # -----------------------------------------------------------------------------
@@ -17,10 +19,23 @@ num_samples = 10 # number of samples to draw
 max_new_tokens = 500 # number of tokens generated in each sample
 temperature = 0.8 # 1.0 = no change, < 1.0 = less random, > 1.0 = more random, in predictions
 top_k = 200 # retain only the top_k most likely tokens, clamp others to have 0 probability
+top_p = 1.0 # nucleus sampling: retain the most likely tokens that make up top_p of the probability mass, 1.0 = off
+min_p = 0.0 # retain only tokens at least min_p times as likely as the most likely one, 0.0 = off
+repetition_penalty = 1.0 # > 1.0 discourages tokens already in the sample (CTRL-style), 1.0 = off
+frequency_penalty = 0.0 # subtracted from the logits of a token once for every time it already occurred
+presence_penalty = 0.0 # subtracted from the logits of every token that already occurred
+use_kv_cache = True # cache keys/values so each step only forwards the newest token
+batched = True # draw all num_samples in one batch (always uses the kv cache)
+stream = False # print every sample token by token as it is generated (one sample at a time)
+stop_at_eot = False # end a sample early when it produces the <|endoftext|> token (GPT-2 encodings only)
+draft_out_dir = '' # out_dir of a small model with the same tokenizer to use for speculative decoding, '' = off
+num_draft = 4 # number of tokens the draft model proposes per step of speculative decoding
 seed = 1337
 device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
 dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32' or 'bfloat16' or 'float16'
 compile = False # use PyTorch 2.0 to compile the model to be faster
+weight_file = '' # write all weights to this binary blob and output.json as its manifest (GPT.from_export loads it back), '' = base64 previews only
+quantization = '' # 'int8' or 'int4' weight-only linear layers for CPU inference, loads out_dir/ckpt_<quantization>.pt written by quantize.py
 exec(open('configurator.py').read()) # overrides from command line or config file
 # -----------------------------------------------------------------------------
 
@@ -33,26 +48,31 @@ ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torc
 ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
 
 # model
+def load_checkpoint(out_dir, quantization=''):
+    # init from a model saved in a specific directory, or from its quantized copy
+    ckpt_path = os.path.join(out_dir, f'ckpt_{quantization}.pt' if quantization else 'ckpt.pt')
+    t0 = time.time()
+    model, checkpoint = GPT.from_checkpoint(ckpt_path, device)
+    print(f"loaded {ckpt_path} in {(time.time() - t0)*1000:.0f}ms")
+    return model, checkpoint
+
 if init_from == 'resume':
-    # init from a model saved in a specific directory
-    ckpt_path = os.path.join(out_dir, 'ckpt.pt')
-    checkpoint = torch.load(ckpt_path, map_location=device)
-    gptconf = GPTConfig(**checkpoint['model_args'])
-    model = GPT(gptconf)
-    state_dict = checkpoint['model']
-    unwanted_prefix = '_orig_mod.'
-    for k,v in list(state_dict.items()):
-        if k.startswith(unwanted_prefix):
-            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
-    model.load_state_dict(state_dict)
+    model, checkpoint = load_checkpoint(out_dir, quantization)
 elif init_from.startswith('gpt2'):
     # init from a given GPT-2 model
     model = GPT.from_pretrained(init_from, dict(dropout=0.0))
+    if quantization:
+        model.quantize({'int8': 8, 'int4': 4}[quantization])
 
 model.eval()
 model.to(device)
 if compile:
     model = torch.compile(model) # requires PyTorch 2.0 (optional)
+draft_model = None
+if draft_out_dir:
+    draft_model, _ = load_checkpoint(draft_out_dir)
+    draft_model.eval()
+    draft_model.to(device)
 
 # look for the meta pickle in case it is available in the dataset folder
 load_meta = False
@@ -67,12 +87,17 @@ if load_meta:
     stoi, itos = meta['stoi'], meta['itos']
     encode = lambda s: [stoi[c] for c in s]
     decode = lambda l: ''.join([itos[i] for i in l])
+    eot_token = None
 else:
     # ok let's assume gpt-2 encodings by default
     print("No meta.pkl found, assuming GPT-2 encodings...")
     enc = tiktoken.get_encoding("gpt2")
     encode = lambda s: enc.encode(s, allowed_special={"<|endoftext|>"})
     decode = lambda l: enc.decode(l)
+    eot_token = enc.eot_token
+
+sampler = Sampler(temperature, top_k, top_p=top_p, min_p=min_p, repetition_penalty=repetition_penalty,
+                  frequency_penalty=frequency_penalty, presence_penalty=presence_penalty)
 
 # encode the beginning of the prompt
 if start.startswith('FILE:'):
@@ -87,12 +112,38 @@ for block in model.transformer.h:
 # run generation
 with torch.no_grad():
     with ctx:
-        config = model.get_config()
-        json_data = json.dumps(config, indent=2)
-        with open('output.json', 'w') as f:
-            f.write(json_data)
+        if weight_file:
+            model.export('output.json', weight_file)
+        else:
+            config = model.get_config()
+            json_data = json.dumps(config, indent=2)
+            with open('output.json', 'w') as f:
+                f.write(json_data)
 
-        for k in range(num_samples):
-            y = model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k)
-            print(decode(y[0].tolist()))
-            print('---------------')
+        if draft_model is not None:
+            for k in range(num_samples):
+                y, stats = model.generate_speculative(x, draft_model, max_new_tokens, num_draft=num_draft, sampler=sampler)
+                print(decode(y[0].tolist()))
+                print(f"[speculative: {stats['acceptance_rate']*100:.1f}% of drafted tokens accepted, {stats['tokens_per_round']:.2f} tokens per forward of the model]")
+                print('---------------')
+        elif stream:
+            for k in range(num_samples):
+                decoder = IncrementalDecoder(decode)
+                print(start, end='', flush=True)
+                for idx_next in model.generate_stream(x, max_new_tokens, use_kv_cache=use_kv_cache, sampler=sampler):
+                    print(decoder.push(idx_next.item()), end='', flush=True)
+                    if stop_at_eot and idx_next.item() == eot_token:
+                        break
+                print(decoder.flush())
+                print('---------------')
+        elif batched:
+            ys = model.generate_batch([start_ids] * num_samples, max_new_tokens, eot_token=eot_token if stop_at_eot else None,
+                                      sampler=sampler)
+            for y in ys:
+                print(decode(start_ids + y))
+                print('---------------')
+        else:
+            for k in range(num_samples):
+                y = model.generate(x, max_new_tokens, use_kv_cache=use_kv_cache, sampler=sampler)
+                print(decode(y[0].tolist()))
+                print('---------------')
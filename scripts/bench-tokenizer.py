@@ -0,0 +1,49 @@
+"""
+Load time of a tokenizer from train_tokenizer.py: vocab.json (json.load, then build_merges) against
+the binary file of BPE.dump_binary, up to a ready vocab and up to the first encode and decode.
+$ python scripts/bench-tokenizer.py -i tokenizer_model/vocab.json
+The binary file is written next to the json (tokenizer.bin) if it is not there yet.
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tokenizer.ebpe import BPE
+
+def bench(load, repeat):
+    # milliseconds to a loaded vocab, and to a finished encode() + decode() after it
+    loaded, ready = [], []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        bpe = BPE(None)
+        load(bpe)
+        t1 = time.perf_counter()
+        bpe.decode(bpe.encode(" Once upon a time"))
+        t2 = time.perf_counter()
+        loaded.append(t1 - t0)
+        ready.append(t2 - t0)
+    return np.median(loaded) * 1000, np.median(ready) * 1000
+
+def main(args):
+    output = args.output or os.path.join(os.path.dirname(args.input), 'tokenizer.bin')
+    if not os.path.exists(output):
+        bpe = BPE(None)
+        bpe.load_vocab(args.input)
+        bpe.dump_binary(output)
+    for name, path, load in [
+        ('json', args.input, lambda bpe: bpe.load_vocab(args.input)),
+        ('binary', output, lambda bpe: bpe.load_binary(output)),
+    ]:
+        loaded, ready = bench(load, args.repeat)
+        print(f"{name:6s} {os.path.getsize(path) / 1024:8.0f}KB  vocab {loaded:7.2f}ms  first encode {ready:7.2f}ms")
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-i', '--input', default='tokenizer_model/vocab.json')
+parser.add_argument('-o', '--output', default='')
+parser.add_argument('--repeat', type=int, default=20)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
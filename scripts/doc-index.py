@@ -0,0 +1,33 @@
+"""
+Writes the document index (<split>.idx) that packing needs for a .bin that was prepared without
+one, by splitting the tokens after every end-of-text token: the index is the uint64 start offset
+of every document, plus the total number of tokens.
+$ python scripts/doc-index.py -i data/openwebtext/train.bin
+"""
+import numpy as np
+import os
+import sys
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataloader import dataset_meta
+
+def main(args):
+    data = np.memmap(args.input, dtype=dataset_meta(os.path.dirname(args.input))['dtype'], mode='r')
+    starts = [np.zeros(1, dtype=np.uint64)]
+    chunk = 1 << 26
+    for i in range(0, len(data), chunk):
+        eot = np.flatnonzero(data[i:i+chunk] == args.eot) + i + 1 # a document starts after every eot
+        starts.append(eot.astype(np.uint64))
+    offsets = np.concatenate(starts + [np.array([len(data)], dtype=np.uint64)])
+    offsets = np.unique(offsets) # no empty document after a trailing eot
+    output = args.output or os.path.splitext(args.input)[0] + '.idx'
+    offsets.tofile(output)
+    print(f"{len(offsets) - 1:,} documents, written to {output}")
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-i', '--input', default='data/openwebtext/train.bin')
+parser.add_argument('-o', '--output', default='')
+parser.add_argument('--eot', type=int, default=50256) # the gpt2 <|endoftext|> token
+args = parser.parse_args()
+
+main(args)
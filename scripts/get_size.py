@@ -1,11 +1,14 @@
 import numpy as np
 import os
+import sys
 import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataloader import dataset_meta
 
 def main(args):
     input_dir = args.input_dir
 
-    data = np.memmap(os.path.join(input_dir, 'train.bin'), dtype=np.uint16, mode='r')
+    data = np.memmap(os.path.join(input_dir, 'train.bin'), dtype=dataset_meta(input_dir)['dtype'], mode='r')
 
     n_data = len(data)
     print(n_data)
@@ -0,0 +1,196 @@
+"""
+Streaming, parallel tokenization of local text files into sharded .bin files, in a single pass with
+bounded memory, instead of going through huggingface datasets like data/*/prepare.py:
+$ python scripts/prepare-stream.py -i 'raw/*.jsonl' -o data/mycorpus
+$ python train.py --dataset=mycorpus
+Inputs are .jsonl files (a document per line, its text under --field) or plain text files (a
+document per line). Chunks of --chunk_docs documents are tokenized by a pool of processes, and the
+results are appended in order to the shards of output_dir:
+    train-00000.bin, train-00000.idx   about --shard_tokens tokens each, documents are never split,
+    train-00001.bin, ...               the .idx is the document index that --packing reads
+    val-00000.bin, ...                 every --val_every'th document, starting with the first one
+    manifest.json                      tokenizer, dtype, vocab size, the shards, and how far into the
+                                       inputs they go
+    mixture.json                       the shards as a dataset for train.py (see dataloader.py)
+After every chunk the shards are flushed and the manifest is rewritten, so running the same command
+again after an interruption truncates the shards to the last chunk in the manifest and carries on.
+"""
+import os
+import json
+import glob
+import argparse
+import itertools
+import collections
+import multiprocessing as mp
+import numpy as np
+import tiktoken
+
+enc = None
+
+def init_worker(encoding):
+    global enc
+    enc = tiktoken.get_encoding(encoding)
+
+def tokenize(lines, field, dtype):
+    # runs in the pool: parse and tokenize a chunk, every document followed by the end of text token
+    texts = [json.loads(line)[field] if field else line for line in lines]
+    ids = enc.encode_ordinary_batch(texts)
+    for doc in ids:
+        doc.append(enc.eot_token)
+    lens = np.array([len(doc) for doc in ids], dtype=np.int64)
+    tokens = np.fromiter(itertools.chain.from_iterable(ids), dtype=dtype, count=int(lens.sum()))
+    return tokens, lens
+
+class ShardWriter:
+    # appends documents to the shards of one split, the manifest keeps the list of shards
+
+    def __init__(self, out_dir, split, shards, dtype, shard_tokens):
+        self.out_dir, self.split, self.shards = out_dir, split, shards
+        self.dtype, self.shard_tokens = np.dtype(dtype), shard_tokens
+        self.bin = self.idx = None
+        if shards and not shards[-1]['done']:
+            # back to the last chunk that made it into the manifest
+            shard = shards[-1]
+            self._open(shard, 'r+b')
+            self.bin.truncate(shard['tokens'] * self.dtype.itemsize)
+            self.idx.truncate(shard['docs'] * 8)
+            self.bin.seek(0, os.SEEK_END)
+            self.idx.seek(0, os.SEEK_END)
+
+    def _open(self, shard, mode):
+        self.bin = open(os.path.join(self.out_dir, shard['path']), mode)
+        self.idx = open(os.path.join(self.out_dir, shard['path'][:-len('.bin')] + '.idx'), mode)
+
+    def _close(self):
+        shard = self.shards[-1]
+        np.array([shard['tokens']], dtype=np.uint64).tofile(self.idx) # the index ends with the total
+        shard['done'] = True
+        self.bin.close()
+        self.idx.close()
+        self.bin = self.idx = None
+        print(f"{shard['path']}: {shard['docs']:,} documents, {shard['tokens']:,} tokens")
+
+    def write(self, tokens, lens):
+        # documents go to the open shard up to the one that takes it to shard_tokens, then a new one starts
+        starts = np.concatenate([[0], np.cumsum(lens)])
+        i = 0
+        while i < len(lens):
+            if self.bin is None:
+                shard = {'path': f'{self.split}-{len(self.shards):05d}.bin', 'tokens': 0, 'docs': 0, 'done': False}
+                self.shards.append(shard)
+                self._open(shard, 'wb')
+            shard = self.shards[-1]
+            room = self.shard_tokens - shard['tokens']
+            j = min(i + 1 + int(np.searchsorted(starts[i+1:] - starts[i], room)), len(lens))
+            (shard['tokens'] + starts[i:j] - starts[i]).astype(np.uint64).tofile(self.idx)
+            tokens[starts[i]:starts[j]].tofile(self.bin)
+            shard['tokens'] += int(starts[j] - starts[i])
+            shard['docs'] += j - i
+            if shard['tokens'] >= self.shard_tokens:
+                self._close()
+            i = j
+
+    def flush(self, final=False):
+        if self.bin is not None:
+            if final:
+                self._close()
+            else:
+                self.bin.flush()
+                self.idx.flush()
+
+def save_manifest(manifest, path):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+def read_lines(paths, skip):
+    # every line of every input, after the first skip ones
+    n = 0
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                n += 1
+                if n > skip:
+                    yield line.rstrip('\n')
+
+def main(args):
+    assert args.val_every > 0, "train.py evaluates on a val split, --val_every must be at least 1"
+    os.makedirs(args.output_dir, exist_ok=True)
+    inputs = sorted(glob.glob(args.input))
+    assert inputs, f"no input matches {args.input}"
+    field = args.field if inputs[0].endswith('.jsonl') else None
+    encoding = tiktoken.get_encoding(args.encoding)
+    dtype = 'uint16' if encoding.n_vocab <= 2**16 else 'uint32'
+    manifest_path = os.path.join(args.output_dir, 'manifest.json')
+    manifest = {
+        'encoding': args.encoding, 'dtype': dtype, 'vocab_size': encoding.n_vocab, 'eot_token': encoding.eot_token,
+        'inputs': inputs, 'field': field, 'val_every': args.val_every,
+        'val_offset': 0, 'lines': 0, 'docs': 0, 'shards': {'train': [], 'val': []},
+    }
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+        for key in ['encoding', 'inputs', 'field', 'val_every']:
+            assert previous[key] == manifest[key], f"{manifest_path} was written with a different {key}"
+        manifest = previous
+        print(f"resuming after {manifest['lines']:,} lines, {manifest['docs']:,} documents")
+    with open(os.path.join(args.output_dir, 'mixture.json'), 'w') as f:
+        # the first document goes to val, so there always is a val split
+        json.dump({'train': [{'path': 'train-*.bin'}], 'val': [{'path': 'val-*.bin'}]}, f, indent=2)
+    writers = {split: ShardWriter(args.output_dir, split, manifest['shards'][split], dtype, args.shard_tokens)
+               for split in ['train', 'val']}
+
+    def chunks():
+        lines = []
+        for line in read_lines(inputs, manifest['lines']):
+            lines.append(line)
+            if len(lines) == args.chunk_docs:
+                yield lines
+                lines = []
+        if lines:
+            yield lines
+
+    def commit(n_lines, result):
+        tokens, lens = result
+        docs = manifest['docs'] + np.arange(len(lens))
+        val = docs % args.val_every == manifest['val_offset']
+        starts = np.concatenate([[0], np.cumsum(lens)])
+        for split, mask in [('train', ~val), ('val', val)]:
+            if mask.any():
+                rows = np.flatnonzero(mask)
+                writers[split].write(np.concatenate([tokens[starts[i]:starts[i+1]] for i in rows]), lens[rows])
+            writers[split].flush()
+        manifest['lines'] += n_lines
+        manifest['docs'] += len(lens)
+        save_manifest(manifest, manifest_path)
+
+    # results are committed in order; at most 2 chunks per process are in flight, which bounds the memory
+    with mp.Pool(args.num_proc, initializer=init_worker, initargs=(args.encoding,)) as pool:
+        pending = collections.deque()
+        for lines in chunks():
+            docs = [line for line in lines if line.strip()] # blank lines are not documents
+            pending.append((len(lines), pool.apply_async(tokenize, (docs, field, dtype))))
+            if len(pending) >= 2 * args.num_proc:
+                n_lines, result = pending.popleft()
+                commit(n_lines, result.get())
+        while pending:
+            n_lines, result = pending.popleft()
+            commit(n_lines, result.get())
+    for writer in writers.values():
+        writer.flush(final=True)
+    save_manifest(manifest, manifest_path)
+    print(f"{manifest['docs']:,} documents from {len(inputs)} files")
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-i', '--input', default='raw/*.jsonl') # a glob, .jsonl or text files
+parser.add_argument('-o', '--output_dir', default='data/mycorpus')
+parser.add_argument('--field', default='text') # the key of the text in the .jsonl lines
+parser.add_argument('--encoding', default='gpt2') # a tiktoken encoding, vocabularies over 65536 tokens are written as uint32
+parser.add_argument('--shard_tokens', type=int, default=2**28)
+parser.add_argument('--chunk_docs', type=int, default=1024)
+parser.add_argument('--val_every', type=int, default=2000) # 1 in 2000 documents goes to val, as in openwebtext/prepare.py
+parser.add_argument('--num_proc', type=int, default=os.cpu_count())
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
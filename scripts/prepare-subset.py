@@ -1,33 +1,50 @@
 import numpy as np
 import os
+import sys
+import json
 import argparse
 import shutil
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataloader import dataset_meta
+
+# the subset is virtual: output_dir gets a mixture.json that points at the first portion of
+# input_dir/train.bin (and all of val.bin), see data_sources in dataloader.py, no tokens are copied
 
 def main(args):
     input_dir = args.input_dir
     output_dir = args.output_dir
     portion = args.portion
 
-    data = np.memmap(os.path.join(input_dir, 'train.bin'), dtype=np.uint16, mode='r')
-    
+    manifest_path = os.path.join(input_dir, 'manifest.json')
+    manifest = json.load(open(manifest_path)) if os.path.exists(manifest_path) else {}
+    data = np.memmap(os.path.join(input_dir, 'train.bin'), dtype=dataset_meta(input_dir)['dtype'], mode='r')
+
     n_data = len(data)
-    # n_subset = int(n_data * portion)
-    n_subset = int(0.1 * 9035582489)
+    n_subset = int(n_data * portion)
 
     print(n_subset)
 
-    data_subset = np.memmap(os.path.join(output_dir, 'train.bin'), dtype=np.uint16, mode='w+', shape=(n_subset,))
-    data_subset[:n_subset] = data[:n_subset]
-
-    data_subset.flush()
+    os.makedirs(output_dir, exist_ok=True)
+    rel = os.path.relpath(input_dir, output_dir)
+    spec = {
+        'train': [{'path': os.path.join(rel, 'train.bin'), 'end': n_subset}],
+        'val': [{'path': os.path.join(rel, 'val.bin')}],
+    }
+    with open(os.path.join(output_dir, 'mixture.json'), 'w') as f:
+        json.dump(spec, f, indent=2)
 
-    shutil.copy(os.path.join(input_dir, 'val.bin'), os.path.join(output_dir, 'val.bin'))
+    # the vocabulary goes along, if the dataset has one
+    if manifest:
+        with open(os.path.join(output_dir, 'manifest.json'), 'w') as f:
+            json.dump({k: manifest[k] for k in ['encoding', 'dtype', 'vocab_size'] if k in manifest}, f, indent=2)
+    if os.path.exists(os.path.join(input_dir, 'meta.pkl')):
+        shutil.copy(os.path.join(input_dir, 'meta.pkl'), os.path.join(output_dir, 'meta.pkl'))
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-i', '--input_dir', default='data/openwebtext')
 parser.add_argument('-o', '--output_dir', default='data/openwebtext-subset')
-parser.add_argument('-p', '--portion', default=0.1)
+parser.add_argument('-p', '--portion', type=float, default=0.1)
 
 args = parser.parse_args()
 
@@ -0,0 +1,397 @@
+"""
+Serve a trained model from a long-lived process with continuous batching.
+
+The model stays resident and a scheduler thread runs the decode loop: requests that arrive
+while others are generating are prefilled and join the running batch between decode steps,
+and finished requests leave it right away (iteration-level batching).
+
+HTTP mode (default), e.g. for the baby shakespeare model on a laptop:
+$ python serve.py --out_dir=out-shakespeare-char --device=cpu
+$ curl -N localhost:8000/generate -d '{"prompt": "ROMEO:", "max_new_tokens": 100}'
+$ curl localhost:8000/metrics
+
+POST /generate takes a json body with "prompt" and optionally "max_new_tokens", "temperature"
+and "stop_at_eot", and streams newline-delimited json: one {"token", "text"} line per token
+followed by a final {"done": true, ...} summary (or only the summary with "stream": false).
+GET /metrics reports throughput, queue depth and time-to-first-token.
+
+stdio mode reads one such json request per line from stdin (with an optional "id" that is
+echoed back) and writes the events of all requests interleaved as json lines to stdout:
+$ python serve.py --out_dir=out-shakespeare-char --device=cpu --mode=stdio
+"""
+import os
+import sys
+import json
+import time
+import pickle
+import queue
+import threading
+import itertools
+from collections import deque
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import torch
+import tiktoken
+from model import GPT, KVCache, Sampler
+from tokenizer.incremental import IncrementalDecoder
+
+# -----------------------------------------------------------------------------
+init_from = 'resume' # either 'resume' (from an out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
+out_dir = 'out' # ignored if init_from is not 'resume'
+mode = 'http' # 'http' or 'stdio'
+host = '127.0.0.1'
+port = 8000
+max_batch_size = 16 # max number of requests decoded together, the rest wait in the queue
+max_new_tokens = 256 # default number of tokens generated per request
+temperature = 0.8 # default temperature, requests can override it
+top_k = 200 # retain only the top_k most likely tokens, clamp others to have 0 probability
+top_p = 1.0 # nucleus sampling: retain the most likely tokens that make up top_p of the probability mass, 1.0 = off
+min_p = 0.0 # retain only tokens at least min_p times as likely as the most likely one, 0.0 = off
+seed = 1337
+device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
+dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32' or 'bfloat16' or 'float16'
+compile = False # use PyTorch 2.0 to compile the model to be faster
+quantization = '' # 'int8' or 'int4' weight-only linear layers for CPU inference, loads out_dir/ckpt_<quantization>.pt written by quantize.py
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+if mode == 'stdio':
+    # stdout carries the protocol, send all other prints to stderr
+    protocol_out, sys.stdout = sys.stdout, sys.stderr
+
+torch.manual_seed(seed)
+torch.cuda.manual_seed(seed)
+torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
+torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
+device_type = 'cuda' if 'cuda' in device else 'cpu' # for later use in torch.autocast
+ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+
+# model
+if init_from == 'resume':
+    # init from a model saved in a specific directory, or from its quantized copy
+    ckpt_path = os.path.join(out_dir, f'ckpt_{quantization}.pt' if quantization else 'ckpt.pt')
+    model, checkpoint = GPT.from_checkpoint(ckpt_path, device)
+elif init_from.startswith('gpt2'):
+    # init from a given GPT-2 model
+    model = GPT.from_pretrained(init_from, dict(dropout=0.0))
+    if quantization:
+        model.quantize({'int8': 8, 'int4': 4}[quantization])
+
+model.eval()
+model.to(device)
+if compile:
+    model = torch.compile(model) # requires PyTorch 2.0 (optional)
+block_size = model.config.block_size
+
+# look for the meta pickle in case it is available in the dataset folder
+load_meta = False
+if init_from == 'resume' and 'config' in checkpoint and 'dataset' in checkpoint['config']: # older checkpoints might not have these...
+    meta_path = os.path.join('data', checkpoint['config']['dataset'], 'meta.pkl')
+    load_meta = os.path.exists(meta_path)
+if load_meta:
+    print(f"Loading meta from {meta_path}...")
+    with open(meta_path, 'rb') as f:
+        meta = pickle.load(f)
+    stoi, itos = meta['stoi'], meta['itos']
+    encode = lambda s: [stoi[c] for c in s]
+    decode = lambda l: ''.join([itos[i] for i in l])
+    eot_token = None
+else:
+    # ok let's assume gpt-2 encodings by default
+    print("No meta.pkl found, assuming GPT-2 encodings...")
+    enc = tiktoken.get_encoding("gpt2")
+    encode = lambda s: enc.encode(s, allowed_special={"<|endoftext|>"})
+    decode = lambda l: enc.decode(l)
+    eot_token = enc.eot_token
+
+# -----------------------------------------------------------------------------
+# continuous batching scheduler
+
+class Request:
+    """ one generation request, the scheduler pushes its events (dicts) onto self.events """
+    keys = itertools.count() # internal ids, unlike the client's rid these are unique
+
+    def __init__(self, prompt_ids, max_new_tokens, temperature, stop_at_eot, events, rid=None):
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.stop_at_eot = stop_at_eot
+        self.events = events
+        self.rid = rid
+        self.key = next(Request.keys) # tags the events, the front ends drop it before writing them out
+        self.tokens = [] # generated so far
+        self.cancelled = False # set when the client goes away, the row is retired at the next step
+        self.t_arrival = time.time()
+        self.t_first = None
+
+    def finish_reason(self, tok):
+        if self.cancelled:
+            return 'cancelled'
+        if self.stop_at_eot and tok == eot_token:
+            return 'eot'
+        if len(self.tokens) >= self.max_new_tokens:
+            return 'length'
+        return None
+
+class Scheduler:
+
+    def __init__(self, model):
+        self.model = model
+        self.waiting = queue.Queue() # requests not yet admitted to the batch
+        self.active = [] # requests in the running batch, in kv cache row order
+        self.kv_cache = KVCache(model.config, 0)
+        self.idx_next = None # (b, 1) tokens sampled last for the running batch, not yet in the cache
+        self.stopping = False
+        # metrics
+        self.lock = threading.Lock()
+        self.t_start = time.time()
+        self.tokens_generated = 0
+        self.requests_completed = 0
+        self.steps = deque(maxlen=100) # (time, tokens) of recent steps, for the throughput estimate
+        self.ttft = deque(maxlen=1000) # recent time-to-first-token values, in seconds
+
+    def submit(self, req):
+        self.waiting.put(req)
+
+    def shutdown(self):
+        # finish the requests already submitted, then make run() return
+        self.stopping = True
+        self.waiting.put(None) # wake up the scheduler if it is idle
+
+    def run(self):
+        while self.step():
+            pass
+
+    def step(self):
+        # admit waiting requests, blocking while there is nothing to do at all
+        new = [] if self.active else [self.waiting.get()]
+        while len(self.active) + len(new) < max_batch_size:
+            try:
+                new.append(self.waiting.get_nowait())
+            except queue.Empty:
+                break
+        new = [req for req in new if req is not None] # None only wakes us up, see shutdown()
+        try:
+            with torch.no_grad(), ctx:
+                if new:
+                    self.admit(new)
+                if self.active:
+                    self.decode()
+        except Exception as e:
+            # fail everything in flight rather than taking the whole server down
+            for req in self.active + [req for req in new if req not in self.active]:
+                req.events.put({'id': req.rid, 'key': req.key, 'done': True, 'error': repr(e)})
+            self.active, self.idx_next = [], None
+            self.kv_cache = KVCache(self.model.config, 0)
+        return not (self.stopping and not self.active and self.waiting.empty())
+
+    def admit(self, new):
+        # prefill the new requests as their own left-padded batch, sample their first tokens
+        # and then append their rows to the running batch
+        cache = KVCache(self.model.config, len(new))
+        logits = self.model.prefill([req.prompt_ids[-block_size:] for req in new], cache)
+        new, idx_next = self.sample(new, logits, cache)
+        if new:
+            self.kv_cache.extend(cache)
+            self.active += new
+            self.idx_next = idx_next if self.idx_next is None else torch.cat((self.idx_next, idx_next))
+
+    def decode(self):
+        # one decode step for the whole running batch
+        kv_cache = self.kv_cache
+        if kv_cache.pos == block_size:
+            # out of positions: reclaim padding shared by all rows, else slide the window
+            # by re-encoding the most recent half block of every row (like GPT.generate)
+            kv_cache.trim()
+        if kv_cache.pos == block_size:
+            window = max(block_size // 2, 1)
+            logits = self.model.prefill([(req.prompt_ids + req.tokens)[-window:] for req in self.active], kv_cache)
+        else:
+            logits, _ = self.model(self.idx_next, kv_cache=kv_cache)
+        self.active, self.idx_next = self.sample(self.active, logits, kv_cache)
+
+    def sample(self, reqs, logits, cache):
+        # sample the next token of every row, stream it out and retire the finished rows.
+        # returns the surviving requests and their sampled tokens (b, 1)
+        temps = torch.tensor([req.temperature for req in reqs], device=logits.device)[:, None]
+        idx_next = Sampler(temps, top_k, top_p=top_p, min_p=min_p)(logits[:, -1, :])
+        now = time.time()
+        keep = []
+        for row, (req, tok) in enumerate(zip(reqs, idx_next.view(-1).tolist())):
+            if req.t_first is None:
+                req.t_first = now
+                with self.lock:
+                    self.ttft.append(now - req.t_arrival)
+            req.tokens.append(tok)
+            req.events.put({'id': req.rid, 'key': req.key, 'token': tok})
+            reason = req.finish_reason(tok)
+            if reason is None:
+                keep.append(row)
+                continue
+            req.events.put({'id': req.rid, 'key': req.key, 'done': True, 'finish_reason': reason, 'tokens': req.tokens,
+                            'ttft_ms': (req.t_first - req.t_arrival) * 1000, 'total_ms': (now - req.t_arrival) * 1000})
+            with self.lock:
+                self.requests_completed += 1
+        with self.lock:
+            self.tokens_generated += len(reqs)
+            self.steps.append((now, len(reqs)))
+        if len(keep) < len(reqs):
+            rows = torch.tensor(keep, dtype=torch.long, device=idx_next.device)
+            cache.select(rows)
+            reqs, idx_next = [reqs[row] for row in keep], idx_next[rows]
+        return reqs, idx_next
+
+    def metrics(self):
+        with self.lock:
+            steps, ttft = list(self.steps), sorted(self.ttft)
+            tokens_per_sec = 0.0
+            if len(steps) > 1 and steps[-1][0] > steps[0][0]:
+                tokens_per_sec = sum(n for _, n in steps[1:]) / (steps[-1][0] - steps[0][0])
+            return {
+                'uptime_s': time.time() - self.t_start,
+                'queue_depth': self.waiting.qsize(),
+                'batch_size': len(self.active),
+                'tokens_generated': self.tokens_generated,
+                'requests_completed': self.requests_completed,
+                'tokens_per_sec': tokens_per_sec,
+                'ttft_avg_ms': 1000 * sum(ttft) / len(ttft) if ttft else None,
+                'ttft_p50_ms': 1000 * ttft[len(ttft) // 2] if ttft else None,
+                'ttft_p90_ms': 1000 * ttft[int(len(ttft) * 0.9)] if ttft else None,
+            }
+
+def make_request(body, events):
+    # build a Request from a parsed json body, raises ValueError/KeyError/TypeError on bad input
+    prompt_ids = encode(body['prompt'])
+    temp = float(body.get('temperature', temperature))
+    n = int(body.get('max_new_tokens', max_new_tokens))
+    if not prompt_ids or temp <= 0 or n <= 0:
+        raise ValueError("need a non-empty prompt, temperature > 0 and max_new_tokens > 0")
+    return Request(prompt_ids, n, temp, bool(body.get('stop_at_eot', False)), events, rid=body.get('id'))
+
+scheduler = Scheduler(model)
+scheduler_thread = threading.Thread(target=scheduler.run, daemon=True)
+scheduler_thread.start()
+
+# -----------------------------------------------------------------------------
+# front ends
+
+class Handler(BaseHTTPRequestHandler):
+
+    def send_json(self, code, obj):
+        data = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_json(200, scheduler.metrics())
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/generate':
+            return self.send_json(404, {'error': 'not found'})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            req = make_request(body, queue.Queue())
+        except (ValueError, KeyError, TypeError) as e:
+            return self.send_json(400, {'error': str(e)})
+        scheduler.submit(req)
+        if not body.get('stream', True):
+            while True:
+                event = req.events.get()
+                if event.get('done'):
+                    break
+            event.pop('key')
+            event['text'] = decode(event.get('tokens', []))
+            return self.send_json(200 if 'error' not in event else 500, event)
+        # stream newline-delimited json until the request is done (HTTP/1.0: ends with the connection)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        decoder = IncrementalDecoder(decode)
+        try:
+            while True:
+                event = req.events.get()
+                event.pop('key')
+                if event.get('done'):
+                    event['text'] = decode(event.get('tokens', []))
+                else:
+                    # text holds the characters completed by this token, which may be none yet
+                    event['text'] = decoder.push(event['token'])
+                self.wfile.write((json.dumps(event) + '\n').encode())
+                self.wfile.flush()
+                if event.get('done'):
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            req.cancelled = True
+
+    def log_message(self, format, *args):
+        pass # keep stderr quiet, use /metrics instead
+
+if mode == 'http':
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"serving on http://{host}:{port}")
+    server.serve_forever()
+elif mode == 'stdio':
+    events = queue.Queue() # shared by all requests, tagged with their keys
+    submitted, finished = 0, threading.Semaphore(0)
+    requests = {} # request key -> Request, to cancel the ones whose output fails
+    def writer():
+        decoders = {} # request key -> IncrementalDecoder
+        failed = set() # keys already answered with an error, the rest of their events is dropped
+        while True:
+            event = events.get()
+            key = event.pop('key')
+            if key in failed:
+                if event.get('done'):
+                    failed.discard(key)
+                continue
+            try:
+                if event.get('done'):
+                    decoders.pop(key, None)
+                    event['text'] = decode(event.get('tokens', []))
+                elif 'token' in event:
+                    decoder = decoders.setdefault(key, IncrementalDecoder(decode))
+                    event['text'] = decoder.push(event['token'])
+                line = json.dumps(event)
+            except Exception as e:
+                # e.g. an id of the padded vocab that the tokenizer has no token for: fail this request only
+                decoders.pop(key, None)
+                if not event.get('done'):
+                    failed.add(key)
+                    req = requests.get(key)
+                    if req is not None:
+                        req.cancelled = True
+                event = {'id': event['id'], 'done': True, 'error': repr(e)}
+                line = json.dumps(event)
+            protocol_out.write(line + '\n')
+            protocol_out.flush()
+            if event.get('done'):
+                requests.pop(key, None)
+                finished.release()
+    threading.Thread(target=writer, daemon=True).start()
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        submitted += 1
+        body = None
+        try:
+            body = json.loads(line)
+            req = make_request(body, events)
+            requests[req.key] = req
+            scheduler.submit(req)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            rid = body.get('id') if isinstance(body, dict) else None
+            events.put({'id': rid, 'key': next(Request.keys), 'done': True, 'error': str(e)})
+    # stdin closed: the scheduler finishes the requests in flight and returns,
+    # then wait for the writer to answer every submitted request before exiting
+    scheduler.shutdown()
+    scheduler_thread.join()
+    for _ in range(submitted):
+        finished.acquire()
+else:
+    raise ValueError(f"unknown mode: {mode}")
@@ -1,9 +1,14 @@
 import sys
 from array import array
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, OrderedDict, Counter
 from itertools import chain
 import json
 import heapq
+import os
+import multiprocessing as mp
+from collections import deque
+import numpy as np
+from tokenizer.incremental import IncrementalDecoder
 from tqdm import tqdm
 from typing import Optional, Set, Union, List, Iterable
 import re
@@ -44,21 +49,237 @@ def preproc_idx(full_indices, word_a, word_b):
 class BPE:
     def __init__(self, vocab: Optional[Set[str]]) -> None:
         self.vocab = vocab if vocab else {}
+        self._file_tables = None
+        self.build_merges()
+
+    def build_merges(self):
+        """
+        Precomputes what encode() needs from the vocab, once per vocab instead of once per call:
+        - every symbol (token, or character of a token) gets an integer id, the vocab's own id for
+          tokens, and every split of every token into two symbols a + b becomes an entry of the merge
+          table, keyed by a * stride + b, so candidate pairs are found without joining any strings
+        - the text is cut into chunks that no token can span: between two characters unless the first
+          occurs before the end of some token and the second after its start. encode() runs the merges
+          of every chunk on its own, and caches the ids of chunks it has seen (words mostly)
+        A vocab from load_binary brings these tables along, they are only converted.
+        """
+        if self._file_tables is not None and self._file_tables[0] is self.vocab:
+            return self._tables_from_file()
+        self._merges_for = self.vocab
+        sym = dict(self.vocab)
+        next_id = max(self.vocab.values(), default=-1) + 1
+        self._max_id = next_id - 1
+        for word in self.vocab:
+            for ch in word:
+                if ch not in sym:
+                    sym[ch] = next_id # a character that is not a token by itself, can still be merged
+                    next_id += 1
+        self._unk = next_id # characters that are not in any token
+        self._stride = stride = next_id + 1
+        self._sym = sym
+        self._sym_len = [1] * stride
+        for word, idx in sym.items():
+            self._sym_len[idx] = len(word)
+        self._merge_table = {}
+        not_last, not_first = set(), set()
+        for word, idx in self.vocab.items():
+            for k in range(1, len(word)):
+                a, b = sym.get(word[:k]), sym.get(word[k:])
+                if a is not None and b is not None:
+                    self._merge_table[a * stride + b] = idx
+            not_last.update(word[:-1])
+            not_first.update(word[1:])
+        self._build_chunking(not_last, not_first)
+
+    def _build_chunking(self, not_last, not_first):
+        # the sentinels around the text in _encode_reference may only be left alone if no token has a '#'
+        # next to another character, otherwise encode() falls back to it
+        self._fast = '#' not in not_last and '#' not in not_first
+        chars = lambda cs: ''.join(re.escape(c) for c in sorted(cs))
+        if not_last and not_first:
+            self._chunk_re = re.compile(f"(?s:.(?:(?<=[{chars(not_last)}])[{chars(not_first)}])*)")
+        else:
+            self._chunk_re = re.compile("(?s:.)")
+        self._cache = {}
+        self._not_last, self._not_first = not_last, not_first
+        # the inverse vocab for decode(), indexed by id (None where no token has the id)
+        self._inverse = [None] * (self._max_id + 1)
+        for word, idx in self.vocab.items():
+            self._inverse[idx] = word
+
+    def _tables_from_file(self):
+        vocab, words, ids, n_ids, merges, not_last, not_first = self._file_tables
+        self._merges_for = vocab
+        self._max_id = n_ids - 1
+        self._sym = dict(zip(words, ids))
+        self._unk = max(ids, default=-1) + 1
+        self._stride = stride = self._unk + 1
+        self._sym_len = [1] * stride
+        for word, idx in zip(words, ids):
+            self._sym_len[idx] = len(word)
+        keys = merges[:, 0].astype(np.int64) * stride + merges[:, 1]
+        self._merge_table = dict(zip(keys.tolist(), merges[:, 2].tolist()))
+        self._build_chunking(set(not_last), set(not_first))
+
+    def safe_cut(self, text: str, pos: int) -> int:
+        """
+        The last position at or before pos where text can be cut in two without changing its ids: no
+        token spans it, like the trainer's punctuation or the space before a word. 0 if there is none.
+        """
+        if self._merges_for is not self.vocab:
+            self.build_merges()
+        while pos > 0 and pos < len(text) and text[pos - 1] in self._not_last and text[pos] in self._not_first:
+            pos -= 1
+        return pos
+
+    def encode_batch(self, texts: List[str], num_proc: Optional[int] = None) -> List[List[int]]:
+        """ encode(text) of every text, spread over num_proc processes (default: one per core) """
+        num_proc = num_proc or os.cpu_count()
+        if num_proc == 1 or len(texts) < 2:
+            return [self.encode(text) for text in texts]
+        with mp.Pool(num_proc, initializer=_init_worker, initargs=(self.vocab,)) as pool:
+            return [ids.tolist() for ids in pool.map(_encode_worker, texts, chunksize=max(1, len(texts) // (4 * num_proc)))]
+
+    def encode_file(self, path: str, out_path: str, num_proc: Optional[int] = None, block_chars: int = 1 << 20) -> int:
+        """
+        Encodes a text file as one stream, the same ids as encode(whole file), into out_path as raw
+        uint16 (uint32 for vocab ids of 2**16 and up) and writes a manifest.json next to it, which is
+        what train.py reads. The file is read in blocks of about block_chars, cut where safe_cut
+        allows, and the blocks are encoded by a pool of processes that receive the vocab once each.
+        Returns the number of tokens.
+        """
+        num_proc = num_proc or os.cpu_count()
+        vocab_size = max(self.vocab.values()) + 1
+        dtype = np.uint16 if vocab_size <= 2**16 else np.uint32
+
+        def blocks():
+            rest = ''
+            with open(path, encoding='utf-8') as f:
+                while True:
+                    data = f.read(block_chars)
+                    text = rest + data
+                    if not data:
+                        if text:
+                            yield text
+                        return
+                    # the last character stays, whether a token continues after it depends on the next block
+                    cut = self.safe_cut(text, len(text) - 1)
+                    if cut > 0:
+                        yield text[:cut]
+                    rest = text[cut:]
+
+        n_tokens = 0
+        with open(out_path, 'wb') as out, mp.Pool(num_proc, initializer=_init_worker, initargs=(self.vocab, dtype)) as pool:
+            for ids in _imap_bounded(pool, _encode_worker, blocks(), 2 * num_proc):
+                ids.tofile(out)
+                n_tokens += len(ids)
+        with open(os.path.join(os.path.dirname(out_path), 'manifest.json'), 'w') as f:
+            json.dump({'encoding': 'ebpe', 'dtype': np.dtype(dtype).name, 'vocab_size': vocab_size}, f, indent=2)
+        return n_tokens
 
     def decode(self,ids):
         # given ids (list of integers), return Python string
-        part_bytes = []
-        inverse_vocab = {idx:word for word,idx in self.vocab.items()}
-        for idx in ids:
-            if idx in inverse_vocab:
-                part_bytes.append(inverse_vocab[idx])
-            else:
-                raise ValueError(f"invalid token id: {idx}")
-        text = "".join(part_bytes)
-
-        return text
-
-    def encode(self, text: str) -> List[str]:
+        if self._merges_for is not self.vocab:
+            self.build_merges()
+        inverse = self._inverse
+        if isinstance(ids, np.ndarray):
+            ids = ids.tolist() # python ints index the table much faster than numpy scalars
+        try:
+            if len(ids) and min(ids) < 0:
+                raise IndexError
+            return "".join(map(inverse.__getitem__, ids))
+        except (IndexError, TypeError):
+            # an id past the end of the table, negative, or without a token
+            for idx in ids:
+                if not 0 <= idx < len(inverse) or inverse[idx] is None:
+                    raise ValueError(f"invalid token id: {idx}")
+            raise
+
+    def incremental_decoder(self) -> IncrementalDecoder:
+        # for streaming generation: push() one id at a time, every push decodes only the ids held back
+        return IncrementalDecoder(self.decode)
+
+    def encode(self, text: str) -> List[int]:
+        """ the same ids as _encode_reference(text), chunk by chunk """
+        if self._merges_for is not self.vocab:
+            self.build_merges()
+        if not self._fast:
+            return self._encode_reference(text)
+        cache, ids = self._cache, []
+        if len(cache) > 100000:
+            cache.clear()
+        for chunk in self._chunk_re.findall(text):
+            chunk_ids = cache.get(chunk)
+            if chunk_ids is None:
+                chunk_ids = cache[chunk] = self._encode_chunk(chunk)
+            ids.extend(chunk_ids)
+        return ids
+
+    def _encode_chunk(self, chunk: str) -> List[int]:
+        # _encode_reference on integer ids: tok[i] is the symbol of the segment that starts at i, seg[i]
+        # the length of the segment that starts or ends at i, and pairs are keyed a * stride + b. The
+        # queue pops the highest merged id first, ties (two splits of one token) shorter left side first
+        sym, table, lens, stride = self._sym, self._merge_table, self._sym_len, self._stride
+        n = len(chunk)
+        tok = [sym.get(ch, self._unk) for ch in chunk]
+        seg = [1] * n
+        pair_pos = {}
+        for i in range(n - 1):
+            key = tok[i] * stride + tok[i + 1]
+            if key in table:
+                if key in pair_pos:
+                    pair_pos[key].add(i)
+                else:
+                    pair_pos[key] = {i}
+        queue = [(-table[key], lens[key // stride], key) for key in pair_pos]
+        heapq.heapify(queue)
+        while queue:
+            neg_comb, len_a, key = heapq.heappop(queue)
+            indices = pair_pos.pop(key, None)
+            if indices is None:
+                continue
+            comb, b = -neg_comb, key % stride
+            len_b = lens[b]
+            len_comb = len_a + len_b
+            if key // stride == b:
+                # overlapping occurrences of a + a: the rightmost one wins
+                indices = sorted(indices, reverse=True)
+                new_indices = [indices[0]]
+                for idx in indices[1:]:
+                    if new_indices[-1] - idx != len_a:
+                        new_indices.append(idx)
+                indices = new_indices
+            new_pairs = {}
+            for idx in indices:
+                if not (seg[idx] == len_a and seg[idx + len_a] == len_b):
+                    continue
+                seg[idx] = len_comb
+                seg[idx + len_a] = 0
+                seg[idx + len_comb - 1] = len_comb
+                tok[idx] = comb
+                if idx > 0:
+                    pre_start = idx - seg[idx - 1]
+                    pre_key = tok[pre_start] * stride + comb
+                    if pre_key in table:
+                        new_pairs.setdefault(pre_key, set()).add(pre_start)
+                nxt_start = idx + len_comb
+                if nxt_start < n:
+                    nxt_key = comb * stride + tok[nxt_start]
+                    if nxt_key in table:
+                        new_pairs.setdefault(nxt_key, set()).add(idx)
+            for key, indices in new_pairs.items():
+                pair_pos[key] = indices
+                heapq.heappush(queue, (-table[key], lens[key // stride], key))
+        ids, i = [], 0
+        while i < n:
+            if tok[i] > self._max_id:
+                raise KeyError(chunk[i:i + seg[i]]) # not a token, as _encode_reference would fail
+            ids.append(tok[i])
+            i += seg[i]
+        return ids
+
+    def _encode_reference(self, text: str) -> List[int]:
+        # the original encoder: merges the pairs of the whole text, by descending id of the merged token
         text = f"#{text}#"
         word_pair_pos, pair_freq_queue, seg_status = self.init_count(text)
         while len(pair_freq_queue) > 0:
@@ -138,6 +359,91 @@ class BPE:
     def load_vocab(self, path):
         with open(path) as f:
             self.vocab = json.load(f)
+        self.build_merges()
+
+    def dump_binary(self, path):
+        """
+        Writes the vocab with the tables of build_merges, which load_binary reads back without
+        rebuilding them. Little-endian, after the magic b'EBPE' six uint32: the format version, the
+        number of symbols, one past the largest token id, the number of merges, the number of
+        characters of the text and the bytes per id (2 below 65536 symbol ids, else 4). Then
+            id[symbols]           the id of every symbol: tokens, then characters that only occur
+                                  inside tokens (ids from one past the largest token id)
+            uint32[symbols + 3]   where every symbol, then the characters that can be followed and
+                                  the characters that can be preceded within a token, start in the text
+            id[merges, 3]         left symbol, right symbol, token: every split of every token into
+                                  two symbols, by rank, i.e. the order encode() applies them in (the
+                                  highest token id first, ties shorter left side first)
+            the text, utf-8
+        """
+        if self._merges_for is not self.vocab:
+            self.build_merges()
+        words = list(self._sym)
+        ids = np.array([self._sym[word] for word in words], dtype=np.int64)
+        merges = np.array([(key // self._stride, key % self._stride, idx) for key, idx in self._merge_table.items()],
+                          dtype=np.int64).reshape(-1, 3)
+        merges = merges[np.lexsort((np.array(self._sym_len)[merges[:, 0]], -merges[:, 2]))]
+        texts = words + ["".join(sorted(self._not_last)), "".join(sorted(self._not_first))]
+        offsets = np.concatenate([[0], np.cumsum([len(t) for t in texts])])
+        text = "".join(texts)
+        width = 2 if self._stride <= 2**16 else 4
+        header = np.array([1, len(words), self._max_id + 1, len(merges), len(text), width])
+        with open(path, "wb") as f:
+            f.write(b"EBPE")
+            f.write(header.astype('<u4').tobytes())
+            f.write(ids.astype(f'<u{width}').tobytes())
+            f.write(offsets.astype('<u4').tobytes())
+            f.write(merges.astype(f'<u{width}').tobytes())
+            f.write(text.encode("utf-8"))
+
+    def load_binary(self, path):
+        # the vocab right away, the tables of build_merges on the first encode() or decode()
+        with open(path, "rb") as f:
+            data = f.read()
+        assert data[:4] == b"EBPE", f"{path} is not a tokenizer written by dump_binary"
+        version, n_sym, n_ids, n_merges, n_chars, width = np.frombuffer(data, '<u4', 6, 4).tolist()
+        assert version == 1, f"unknown tokenizer format version {version}"
+        pos = 28
+        ids = np.frombuffer(data, f'<u{width}', n_sym, pos).tolist()
+        pos += width * n_sym
+        offsets = np.frombuffer(data, '<u4', n_sym + 3, pos).tolist()
+        pos += 4 * (n_sym + 3)
+        merges = np.frombuffer(data, f'<u{width}', 3 * n_merges, pos).reshape(-1, 3)
+        pos += 3 * width * n_merges
+        text = data[pos:].decode("utf-8")
+        texts = [text[offsets[i]:offsets[i + 1]] for i in range(n_sym + 2)]
+        words, (not_last, not_first) = texts[:n_sym], texts[n_sym:]
+        self.vocab = {word: idx for word, idx in zip(words, ids) if idx < n_ids}
+        self._file_tables = (self.vocab, words, ids, n_ids, merges, not_last, not_first)
+        self._merges_for = None
+
+def _imap_bounded(pool, func, items, in_flight):
+    # func(item) of every item on the pool, in order, with at most in_flight items submitted and not yet
+    # handed out: items are only pulled as results are taken, which bounds the memory unlike pool.imap
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        while len(pending) >= in_flight or (pending and pending[0].ready()):
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+_worker_bpe = _worker_dtype = None
+
+def _init_worker(vocab, dtype=np.int64):
+    # every process of the pool builds the merge tables once
+    global _worker_bpe, _worker_dtype
+    _worker_bpe, _worker_dtype = BPE(vocab), dtype
+
+def _encode_worker(text):
+    return np.array(_worker_bpe.encode(text), dtype=_worker_dtype)
+
+def _count_units(texts):
+    # the '#'-delimited units of a shard of the corpus and how often each occurs
+    units = Counter()
+    for text in texts:
+        units.update((' ' + BPETrainer.replace_punc(text)).split('#'))
+    return units
 
 class BPETrainer:
     def __init__(self,vocab_size, min_freq: int = 10, compress_threshold: float = 0, single_char: bool=True) -> None:
@@ -174,12 +480,22 @@ class BPETrainer:
         return BPE(self.vocab)
 
     @classmethod
-    def load_file(cls, path: Union[List[str], str], verbose: bool):
+    def load_file(cls, path: Union[List[str], str], verbose: bool, block_chars: int = 1 << 22):
+        # the files in blocks of whole lines, the last newline of a block dropped: joined by "\n"
+        # the blocks are the files joined by "\n", which is all init_word_pair does with them
         path = path if isinstance(path ,list) else [path]
         pbar = tqdm(path) if verbose else path
         for p in pbar:
             with open(p, "r") as f:
-                yield f.read()
+                lines, size = [], 0
+                for line in f:
+                    lines.append(line)
+                    size += len(line)
+                    if size >= block_chars and line.endswith("\n"):
+                        lines[-1] = line[:-1]
+                        yield "".join(lines)
+                        lines, size = [], 0
+                yield "".join(lines)
     
     def init_word_pair(self, corpus_iter, min_freq: int, verbose: bool):
         corpus = self.replace_punc("\n".join(chain([''], corpus_iter, [''])), verbose)
@@ -327,14 +643,7 @@ class BPETrainer:
 
     @staticmethod
     def replace_punc(text: str, verbose: bool = False):
-        if verbose:
-            print("Rmoving duplicate lines...")
-        lines = text.split("\n")
-        new_lines = set(lines)
-        text = "#".join(lines)
-        if verbose:
-            print("lines:", len(lines), "new_lines:", len(new_lines), "ratio:", len(new_lines) / len(lines))
-        del lines
+        # "\n" is one of the puncs, lines end up '#'-separated like everything else
         puncs_zh = [' ', '。', '，', '？', '！', '；', '：', '、', '（', '）', '「',
                     '」', '“', '”', '‘', '’', '《', '》', '【', '】', '…', '—', '～']
         puncs_en = ['.', ',', '?', '!', ';', ':', 
@@ -365,3 +674,259 @@ class BPETrainer:
             result = pattern.sub("# ", text)
             result = re.sub(r'\s*#\s*', '# ', result)
             return result
+
+
+class FastBPETrainer(BPETrainer):
+    """
+    BPETrainer on integer symbol ids, same vocab from the same input.
+    A symbol is a character (its code point) or a merged token (0x110000 on), a pair (a, b) is the
+    integer a << 22 | b. The corpus is kept as seg_status (as in BPETrainer) next to tok, the symbol
+    that starts at every segment start, so neighbours are array lookups instead of string slices.
+    The loop of BPETrainer.merge_word only reads the state from before the merge, which lets every
+    merge run as a few numpy operations over the positions of the winning pair: the pairs that lose
+    an occurrence get their counts decremented by the exact delta, and the positions of the new
+    pairs are grouped with a stable sort, so every position list comes out in BPETrainer's order.
+    The queue holds (-freq, word_a, word_b, pair) to break ties between pairs the same way.
+
+    With collapse_words (the default) the corpus is not kept at all: pairs never cross the '#'s that
+    replace_punc puts between units, and every copy of a unit goes through the same merges, so the
+    trainer keeps every distinct unit once, weighted by how often it occurs. Counts are sums of
+    weights instead of lengths and the merges are the same, with memory that grows with the
+    number of distinct units rather than with the corpus. The units are counted by num_proc
+    processes, over shards of about shard_chars characters cut at line breaks. With dedup_lines,
+    every line after its first occurrence is dropped (only a hash per distinct line is kept).
+    """
+    SHIFT = 22
+    MERGED = 0x110000
+
+    def __init__(self, vocab_size, min_freq: int = 10, compress_threshold: float = 0, single_char: bool = True,
+                 collapse_words: bool = True, num_proc: Optional[int] = None, shard_chars: int = 1 << 22,
+                 dedup_lines: bool = False) -> None:
+        super().__init__(vocab_size, min_freq, compress_threshold, single_char)
+        self.collapse_words = collapse_words
+        self.dedup_lines = dedup_lines
+        self.num_proc = num_proc or os.cpu_count()
+        self.shard_chars = shard_chars
+        self.weight = self.tok = None
+
+    def sym(self, word):
+        # id of a symbol, merged tokens get the next free one
+        if len(word) == 1:
+            return ord(word)
+        idx = self.sym_ids.get(word)
+        if idx is None:
+            idx = self.sym_ids[word] = self.MERGED + len(self.sym_strs)
+            self.sym_strs.append(word)
+        return idx
+
+    def sym_str(self, idx):
+        return chr(idx) if idx < self.MERGED else self.sym_strs[idx - self.MERGED]
+
+    def push(self, freq, pair):
+        a, b = pair >> self.SHIFT, pair & ((1 << self.SHIFT) - 1)
+        heapq.heappush(self.pair_freq_queue, (-freq, self.sym_str(a), self.sym_str(b), pair))
+
+    def size(self, positions):
+        # the number of occurrences behind a list of positions
+        return len(positions) if self.weight is None else int(self.weight[positions].sum())
+
+    def group(self, pairs, positions):
+        # every distinct pair with its positions (in their original order) and its number of occurrences
+        order = np.argsort(pairs, kind='stable')
+        pairs, positions = pairs[order], positions[order]
+        uniq, starts, lens = np.unique(pairs, return_index=True, return_counts=True)
+        if self.weight is None or len(pairs) == 0:
+            counts = lens
+        else:
+            counts = np.add.reduceat(self.weight[positions], starts)
+        return uniq.tolist(), starts.tolist(), lens.tolist(), counts.tolist(), positions
+
+    @staticmethod
+    def unique_lines(corpus_iter, verbose):
+        # the texts without the lines seen before
+        seen = set()
+        n_lines = 0
+        for text in corpus_iter:
+            lines = text.split("\n")
+            n_lines += len(lines)
+            kept = []
+            for line in lines:
+                h = hash(line)
+                if h not in seen:
+                    seen.add(h)
+                    kept.append(line)
+            yield "\n".join(kept)
+        if verbose:
+            print("lines:", n_lines, "distinct:", len(seen), "ratio:", len(seen) / max(n_lines, 1))
+
+    def shards(self, corpus_iter):
+        # lists of texts of about shard_chars characters, longer texts are cut at line breaks, which
+        # replace_punc turns into '#': the units of the two sides are the units of the whole text
+        shard, size = [], 0
+        for text in corpus_iter:
+            start = 0
+            while True:
+                end = text.find('\n', start + self.shard_chars) if len(text) - start > self.shard_chars else -1
+                piece = text[start:] if end < 0 else text[start:end]
+                shard.append(piece)
+                size += len(piece)
+                if size >= self.shard_chars:
+                    yield shard
+                    shard, size = [], 0
+                if end < 0:
+                    break
+                start = end + 1
+        if shard:
+            yield shard
+
+    def load_units(self, corpus_iter, verbose):
+        # the distinct units between the '#'s of the corpus and how often each occurs, in order of appearance
+        units = Counter()
+        if self.num_proc > 1:
+            with mp.Pool(self.num_proc) as pool:
+                for counts in _imap_bounded(pool, _count_units, self.shards(corpus_iter), 2 * self.num_proc):
+                    units.update(counts)
+        else:
+            for shard in self.shards(corpus_iter):
+                units.update(_count_units(shard))
+        if verbose:
+            print("units:", sum(units.values()), "distinct:", len(units))
+        corpus = "#" + "#".join(units) + "# "
+        counts = np.fromiter(units.values(), dtype=np.int64, count=len(units))
+        lens = np.fromiter(map(len, units), dtype=np.int64, count=len(units))
+        # every character weighs as much as its unit occurs, the '#'s in between nothing
+        weight = np.concatenate([[0], np.repeat(counts, lens + 1), [0]])
+        return corpus, weight
+
+    def init_word_pair(self, corpus_iter, min_freq: int, verbose: bool):
+        if self.dedup_lines:
+            corpus_iter = self.unique_lines(corpus_iter, verbose)
+        if self.collapse_words:
+            corpus, self.weight = self.load_units(corpus_iter, verbose)
+        else:
+            corpus = self.replace_punc("\n".join(chain([''], corpus_iter, [''])), verbose)
+            self.weight = None
+        assert 4294967295 > len(corpus)
+        vocab = {f"{bytes([idx]).decode('utf-8', errors='replace')}": idx for idx in range(127)}
+        if verbose:
+            print("Initing pair count...")
+        codes = np.frombuffer(corpus.encode('utf-32-le'), dtype=np.uint32).astype(np.int32)
+        del corpus
+        sep = ord('#')
+        pre, nxt = codes[:-1], codes[1:]
+        word_count = defaultdict(int)
+        if self.single_char:
+            keep = np.flatnonzero(pre != sep)
+            chars, inverse = np.unique(pre[keep], return_inverse=True)
+            counts = np.bincount(inverse, None if self.weight is None else self.weight[keep])
+            word_count.update(zip(map(chr, chars.tolist()), counts.astype(np.int64).tolist()))
+        positions = np.flatnonzero((pre != sep) & (nxt != sep)).astype(np.uint32)
+        pairs = (pre[positions].astype(np.int64) << self.SHIFT) | nxt[positions]
+        uniq, starts, lens, counts, positions = self.group(pairs, positions)
+        del pairs
+
+        self.sym_ids, self.sym_strs = {}, []
+        self.word_pair_pos, self.word_pair_len = {}, {}
+        self.pair_freq_queue = []
+        for pair, start, n, count in zip(uniq, starts, lens, counts):
+            if count >= min_freq:
+                self.word_pair_pos[pair] = positions[start:start + n].copy()
+                self.word_pair_len[pair] = count
+                a, b = pair >> self.SHIFT, pair & ((1 << self.SHIFT) - 1)
+                self.pair_freq_queue.append((-count, chr(a), chr(b), pair))
+        heapq.heapify(self.pair_freq_queue)
+        self.word_count = word_count
+        self.vocab = vocab
+        # one past the end reads as the empty string of BPETrainer's slices, which matches no symbol
+        self.tok = np.concatenate([codes, [-1, -1]]).astype(np.int32)
+        self.seg_status = np.ones(len(codes) + 2, dtype=np.uint16)
+        if verbose:
+            print("init finish!")
+
+    def most_frequent_combination(self):
+        queue = self.pair_freq_queue
+        while len(queue) > 0:
+            cached_freq, word_a, word_b, pair = heapq.heappop(queue)
+            ground_freq = self.word_pair_len[pair]
+            cached_freq = -cached_freq
+            if cached_freq == ground_freq:
+                return (word_a, word_b), cached_freq
+            elif ground_freq > self.min_freq:
+                heapq.heappush(queue, (-ground_freq, word_a, word_b, pair))
+                if ground_freq / self.size(self.word_pair_pos[pair]) < self.compress_threshold:
+                    self.word_pair_pos[pair] = self.compress_indices(word_a, word_b)
+            else:
+                self.word_pair_len.pop(pair, None)
+                self.word_pair_pos.pop(pair, None)
+        return None, 0
+
+    def compress_indices(self, word_a, word_b, indices=None):
+        seg = self.seg_status
+        len_a, len_b = len(word_a), len(word_b)
+        if indices is None:
+            indices = self.word_pair_pos[self.sym(word_a) << self.SHIFT | self.sym(word_b)]
+        i = indices.astype(np.int64)
+        return indices[(seg[i] == len_a) & (seg[i + len_a] == len_b)]
+
+    @staticmethod
+    def preproc_idx(indices, len_a):
+        # preproc_idx for a pair of a symbol with itself: of a run of overlapping occurrences
+        # every other one, counting from the last
+        steps = np.diff(indices)
+        if not (steps > 0).all():
+            return np.array(preproc_idx(array('I', indices.tolist()), 'a' * len_a, 'a' * len_a), dtype=np.int64)
+        run_ends = np.flatnonzero(np.append(steps != len_a, True))
+        to_end = run_ends[np.searchsorted(run_ends, np.arange(len(indices)))] - np.arange(len(indices))
+        return indices[to_end % 2 == 0]
+
+    def merge_word(self, comb, freq):
+        word_a, word_b = comb
+        word_comb = word_a + word_b
+        len_a, len_comb = len(word_a), len(word_comb)
+        a, b, c = self.sym(word_a), self.sym(word_b), self.sym(word_comb)
+        shift, sep = self.SHIFT, ord('#')
+        seg, tok = self.seg_status, self.tok
+        pair = a << shift | b
+        indices = self.word_pair_pos[pair]
+        if self.size(indices) > freq:
+            indices = self.compress_indices(word_a, word_b, indices)
+        indices = indices.astype(np.int64)
+        if a == b:
+            indices = self.preproc_idx(indices, len_a)
+
+        merged = self.size(indices)
+        self.word_count[word_a] -= merged
+        self.word_count[word_b] -= merged
+        nxt_start = indices + len_comb
+        nxt_end = seg[nxt_start] + nxt_start
+        pre_start = indices - seg[indices - 1]
+        pre_word, nxt_word = tok[pre_start].astype(np.int64), tok[nxt_start].astype(np.int64)
+        has_pre = pre_word != sep
+        repeat = has_pre & (pre_word == b) & (tok[pre_start - seg[pre_start - 1]] == a)
+        has_nxt = (nxt_word != sep) & ~((nxt_word == a) & (tok[nxt_end] == b))
+
+        # the pairs that lose an occurrence to the merge
+        lost = np.concatenate([pre_word[has_pre] << shift | a, b << shift | nxt_word[has_nxt]])
+        lost, _, _, counts, _ = self.group(lost, np.concatenate([indices[has_pre], indices[has_nxt]]))
+        for k, n in zip(lost, counts):
+            if k in self.word_pair_len:
+                self.word_pair_len[k] -= n
+
+        # the new pairs, interleaved in the order BPETrainer.merge_word appends them
+        new = np.stack([np.where(repeat, c << shift | c, pre_word << shift | c), c << shift | nxt_word], axis=1)
+        new_pos = np.stack([np.where(repeat, pre_start - len_a, pre_start), indices], axis=1)
+        valid = np.stack([has_pre, has_nxt], axis=1)
+        uniq, starts, lens, counts, new_pos = self.group(new[valid], new_pos[valid].astype(np.uint32))
+        for k, start, n, count in zip(uniq, starts, lens, counts):
+            if count >= self.min_freq:
+                self.word_pair_pos[k] = new_pos[start:start + n]
+                self.word_pair_len[k] = count
+                self.push(count, k)
+
+        seg[indices] = len_comb
+        seg[indices + len_a] = len_comb if len(word_b) == 1 else 0
+        seg[indices + len_comb - 1] = len_comb
+        tok[indices] = c
+
+        self.word_pair_pos.pop(pair)
+        self.word_pair_len.pop(pair)
@@ -0,0 +1,33 @@
+from typing import Callable, List
+
+
+class IncrementalDecoder:
+    """
+    Turns a stream of token ids into text chunks as they arrive, for any decode function
+    that maps a list of ids to a string (tiktoken, the char-level meta.pkl maps, ...).
+
+    A single byte-level BPE token may end in the middle of a multi-byte character, which
+    decodes to a trailing U+FFFD. Such tokens are held back and decoded together with the
+    ones that follow until the character is complete, or until max_pending tokens are
+    waiting (then the text is genuinely invalid and is flushed as is).
+    """
+
+    def __init__(self, decode: Callable[[List[int]], str], max_pending: int = 8) -> None:
+        self.decode = decode
+        self.max_pending = max_pending
+        self.pending: List[int] = []
+
+    def push(self, idx: int) -> str:
+        # add one token id, return the text that became final (possibly empty)
+        self.pending.append(idx)
+        text = self.decode(self.pending)
+        if text.endswith("�") and len(self.pending) < self.max_pending:
+            return ""
+        self.pending = []
+        return text
+
+    def flush(self) -> str:
+        # return whatever is still held back, e.g. at the end of generation
+        text = self.decode(self.pending) if self.pending else ""
+        self.pending = []
+        return text
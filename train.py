@@ -22,12 +22,13 @@ import math
 import pickle
 from contextlib import nullcontext
 
-import numpy as np
 import torch
 from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.distributed import init_process_group, destroy_process_group
+from torch.distributed import init_process_group, destroy_process_group, broadcast
 
 from model import GPTConfig, GPT
+from dataloader import DataLoader, data_sources, dataset_meta
+from checkpoint import CheckpointWriter, latest_checkpoint, load_optimizer_state
 
 # -----------------------------------------------------------------------------
 # default config values designed to train a gpt2 (124M) on OpenWebText
@@ -38,6 +39,8 @@ log_interval = 1
 eval_iters = 200
 eval_only = False # if True, script exits right after the first eval
 always_save_checkpoint = True # if True, always save a checkpoint after each eval
+keep_last = 3 # number of checkpoints kept in out_dir, older ones are deleted (0 = keep all)
+async_checkpoint = True # write checkpoints from a background thread while training goes on
 init_from = 'scratch' # 'scratch' or 'resume' or 'gpt2*'
 # wandb logging
 wandb_log = False # disabled by default
@@ -48,6 +51,9 @@ dataset = 'openwebtext'
 gradient_accumulation_steps = 5 * 8 # used to simulate larger batch sizes
 batch_size = 12 # if gradient_accumulation_steps > 1, this is the micro-batch size
 block_size = 1024
+prefetch = 2 # number of batches prepared ahead of time on a background thread, 0 = load in the training loop
+sampling = 'random' # 'random' windows of train.bin, or 'epoch': a seeded permutation of non-overlapping windows per epoch, resumable
+packing = False # pack whole documents into the rows (needs <split>.idx), attention and positions stay within each document
 # model
 n_layer = 12
 n_head = 12
@@ -111,24 +117,16 @@ device_type = 'cuda' if 'cuda' in device else 'cpu' # for later use in torch.aut
 ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
 ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
 
-# poor man's data loader
+# data loader, prefetching batches on a background thread (the dataset may be a mixture, see dataloader.py)
 data_dir = os.path.join('data', dataset)
+ddp_args = dict(rank=ddp_rank, world_size=ddp_world_size) if ddp else {}
+train_loader = DataLoader(data_sources(data_dir, 'train'), batch_size, block_size, device, prefetch=prefetch,
+                          seed=1337, sampling=sampling, packing=packing, **ddp_args)
+# estimate_loss draws random windows of its own, so evaluating never moves the training data along
+eval_loaders = {split: DataLoader(data_sources(data_dir, split), batch_size, block_size, device, prefetch=prefetch,
+                                  seed=1337, packing=packing, **ddp_args) for split in ['train', 'val']}
 def get_batch(split):
-    # We recreate np.memmap every batch to avoid a memory leak, as per
-    # https://stackoverflow.com/questions/45132940/numpy-memmap-memory-usage-want-to-iterate-once/61472122#61472122
-    if split == 'train':
-        data = np.memmap(os.path.join(data_dir, 'train.bin'), dtype=np.uint16, mode='r')
-    else:
-        data = np.memmap(os.path.join(data_dir, 'val.bin'), dtype=np.uint16, mode='r')
-    ix = torch.randint(len(data) - block_size, (batch_size,))
-    x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix])
-    y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix])
-    if device_type == 'cuda':
-        # pin arrays x,y, which allows us to move them to GPU asynchronously (non_blocking=True)
-        x, y = x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
-    else:
-        x, y = x.to(device), y.to(device)
-    return x, y
+    return train_loader.next_batch() if split == 'train' else eval_loaders[split].next_batch()
 
 # init these up here, can override if init_from='resume' (i.e. from a checkpoint)
 iter_num = 0
@@ -142,6 +140,11 @@ if os.path.exists(meta_path):
         meta = pickle.load(f)
     meta_vocab_size = meta['vocab_size']
     print(f"found vocab_size = {meta_vocab_size} (inside {meta_path})")
+elif dataset_meta(data_dir)['vocab_size'] is not None:
+    # a tokenizer vocabulary from the dataset's manifest, rounded up to a multiple of 64 for efficiency
+    manifest_vocab_size = dataset_meta(data_dir)['vocab_size']
+    meta_vocab_size = (manifest_vocab_size + 63) // 64 * 64
+    print(f"found vocab_size = {manifest_vocab_size}, using {meta_vocab_size} (inside {data_dir}/manifest.json)")
 
 # model init
 model_args = dict(n_layer=n_layer, n_head=n_head, n_embd=n_embd, block_size=block_size,
@@ -157,25 +160,14 @@ if init_from == 'scratch':
     model = GPT(gptconf)
 elif init_from == 'resume':
     print(f"Resuming training from {out_dir}")
-    # resume training from a checkpoint.
-    ckpt_path = os.path.join(out_dir, 'ckpt.pt')
-    checkpoint = torch.load(ckpt_path, map_location=device)
-    checkpoint_model_args = checkpoint['model_args']
-    # force these config attributes to be equal otherwise we can't even resume training
+    # resume training from the newest complete checkpoint.
+    ckpt_path = latest_checkpoint(out_dir)
     # the rest of the attributes (e.g. dropout) can stay as desired from command line
+    model, checkpoint = GPT.from_checkpoint(ckpt_path, override_args=dict(dropout=dropout))
+    # force these config attributes to be equal otherwise we can't even resume training
+    checkpoint_model_args = checkpoint['model_args']
     for k in ['n_layer', 'n_head', 'n_embd', 'block_size', 'bias', 'vocab_size']:
         model_args[k] = checkpoint_model_args[k]
-    # create the model
-    gptconf = GPTConfig(**model_args)
-    model = GPT(gptconf)
-    state_dict = checkpoint['model']
-    # fix the keys of the state dictionary :(
-    # honestly no idea how checkpoints sometimes get this prefix, have to debug more
-    unwanted_prefix = '_orig_mod.'
-    for k,v in list(state_dict.items()):
-        if k.startswith(unwanted_prefix):
-            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
-    model.load_state_dict(state_dict)
     iter_num = checkpoint['iter_num']
     best_val_loss = checkpoint['best_val_loss']
 elif init_from.startswith('gpt2'):
@@ -198,7 +190,11 @@ scaler = torch.cuda.amp.GradScaler(enabled=(dtype == 'float16'))
 # optimizer
 optimizer = model.configure_optimizers(weight_decay, learning_rate, (beta1, beta2), device_type)
 if init_from == 'resume':
-    optimizer.load_state_dict(checkpoint['optimizer'])
+    # the optimizer state lives in its own files so that loading a model for inference never touches it
+    optimizer.load_state_dict(load_optimizer_state(ckpt_path, checkpoint, map_location=device))
+    if 'data' in checkpoint and sampling == 'epoch':
+        # continue from the batch the checkpointed run was about to train on
+        train_loader.load_state_dict(checkpoint['data'])
 checkpoint = None # free up memory
 
 # compile the model
@@ -219,9 +215,9 @@ def estimate_loss():
     for split in ['train', 'val']:
         losses = torch.zeros(eval_iters)
         for k in range(eval_iters):
-            X, Y = get_batch(split)
+            X, Y, D = eval_loaders[split].next_batch()
             with ctx:
-                logits, loss = model(X, Y)
+                logits, loss = model(X, Y, doc_ids=D)
             losses[k] = loss.item()
         out[split] = losses.mean()
     model.train()
@@ -247,10 +243,11 @@ if wandb_log and master_process:
     wandb.init(project=wandb_project, name=wandb_run_name, config=config)
 
 # training loop
-X, Y = get_batch('train') # fetch the very first batch
+X, Y, D = get_batch('train') # fetch the very first batch (D: document ids when packing, else None)
 t0 = time.time()
 local_iter_num = 0 # number of iterations in the lifetime of this process
 raw_model = model.module if ddp else model # unwrap DDP container if needed
+checkpointer = CheckpointWriter(out_dir, keep_last, ddp_rank if ddp else 0, ddp_world_size, background=async_checkpoint)
 running_mfu = -1.0
 while True:
 
@@ -260,30 +257,39 @@ while True:
         param_group['lr'] = lr
 
     # evaluate the loss on train/val sets and write checkpoints
-    if iter_num % eval_interval == 0 and master_process:
-        losses = estimate_loss()
-        print(f"step {iter_num}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}")
-        if wandb_log:
-            wandb.log({
-                "iter": iter_num,
-                "train/loss": losses['train'],
-                "val/loss": losses['val'],
-                "lr": lr,
-                "mfu": running_mfu*100, # convert to percentage
-            })
-        if losses['val'] < best_val_loss or always_save_checkpoint:
-            best_val_loss = losses['val']
-            if iter_num > 0:
-                checkpoint = {
-                    'model': raw_model.state_dict(),
-                    'optimizer': optimizer.state_dict(),
-                    'model_args': model_args,
-                    'iter_num': iter_num,
-                    'best_val_loss': best_val_loss,
-                    'config': config,
-                }
+    if iter_num % eval_interval == 0:
+        save = False
+        if master_process:
+            losses = estimate_loss()
+            print(f"step {iter_num}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}")
+            if wandb_log:
+                wandb.log({
+                    "iter": iter_num,
+                    "train/loss": losses['train'],
+                    "val/loss": losses['val'],
+                    "lr": lr,
+                    "mfu": running_mfu*100, # convert to percentage
+                })
+            if losses['val'] < best_val_loss or always_save_checkpoint:
+                best_val_loss = losses['val']
+                save = iter_num > 0
+        if ddp:
+            # every rank writes its shard of the optimizer state, so they all need to know
+            flag = torch.tensor(save, device=device)
+            broadcast(flag, 0)
+            save = flag.item()
+        if save:
+            checkpoint = {
+                'model': raw_model.state_dict(),
+                'model_args': model_args,
+                'iter_num': iter_num,
+                'best_val_loss': best_val_loss,
+                'config': config,
+                'data': train_loader.state_dict(), # the batch X, Y, not trained on yet
+            } if master_process else None
+            if master_process:
                 print(f"saving checkpoint to {out_dir}")
-                torch.save(checkpoint, os.path.join(out_dir, 'ckpt.pt'))
+            checkpointer.save(iter_num, checkpoint, optimizer)
     if iter_num == 0 and eval_only:
         break
 
@@ -297,10 +303,10 @@ while True:
             # looking at the source of that context manager, it just toggles this variable
             model.require_backward_grad_sync = (micro_step == gradient_accumulation_steps - 1)
         with ctx:
-            logits, loss = model(X, Y)
+            logits, loss = model(X, Y, doc_ids=D)
             loss = loss / gradient_accumulation_steps # scale the loss to account for gradient accumulation
         # immediately async prefetch next batch while model is doing the forward pass on the GPU
-        X, Y = get_batch('train')
+        X, Y, D = get_batch('train')
         # backward pass, with gradient scaling if training in fp16
         scaler.scale(loss).backward()
     # clip the gradient
@@ -332,5 +338,6 @@ while True:
     if iter_num > max_iters:
         break
 
+checkpointer.wait() # let the last checkpoint finish writing
 if ddp:
     destroy_process_group()
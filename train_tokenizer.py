@@ -1,14 +1,18 @@
 import os
 import argparse
 import time
+import resource
 from natsort import natsorted
-from tokenizer.ebpe import BPE,BPETrainer
+from tokenizer.ebpe import BPE,FastBPETrainer
 
 def parse_args():
     parser = argparse.ArgumentParser("Entry script to launch training")
     parser.add_argument("--data-dir", type=str, default = "./data", help="Path to the data directory")
     parser.add_argument("--output-dir", type=str, default = "./tokenizer_model", help="Path to the output file")
     parser.add_argument("--load-pretrained", type =bool, default=False, help="Load trained tokenizer")
+    parser.add_argument("--encode", type=str, nargs=2, metavar=("TEXT_FILE", "BIN_FILE"), default=None, help="Encode a text file into a .bin for train.py")
+    parser.add_argument("--dedup-lines", action="store_true", help="Train on every distinct line once")
+    parser.add_argument("--num-proc", type=int, default=None, help="Processes for counting the training corpus and for --encode, default one per core")
     return parser.parse_args()
 
 def main():
@@ -21,17 +25,31 @@ def main():
 
     if load_pretrained:
         tokenizer=BPE(None)
-        tokenizer.load_vocab(os.path.join(output_dir,"vocab.json"))
+        if os.path.exists(os.path.join(output_dir,"tokenizer.bin")):
+            tokenizer.load_binary(os.path.join(output_dir,"tokenizer.bin"))
+        else:
+            tokenizer.load_vocab(os.path.join(output_dir,"vocab.json"))
     else:
-        tokenizer = BPETrainer(
+        tokenizer = FastBPETrainer(
             int(10000), min_freq=1,
-            compress_threshold=0.3
+            compress_threshold=0.3,
+            num_proc=args.num_proc,
+            dedup_lines=args.dedup_lines,
         ).train_from_file(
             data_dir,
             verbose=True,
         )
+        # ru_maxrss is in KB, for the children it is the largest of the pool's processes
+        print(f"peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f}MB, "
+              f"largest worker: {resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024:.0f}MB")
 
         tokenizer.dump_vocab(os.path.join(output_dir,"vocab.json"))
+        tokenizer.dump_binary(os.path.join(output_dir,"tokenizer.bin"))
+
+    if args.encode:
+        start = time.time()
+        n_tokens = tokenizer.encode_file(*args.encode, num_proc=args.num_proc)
+        print(f"{args.encode[1]}: {n_tokens:,} tokens in {time.time() - start:.1f}s")
 
     text = " Once upon a time, there is a wolf"
     print(tokenizer.encode(text))